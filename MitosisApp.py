@@ -4,34 +4,2164 @@ CAMDU Mitosis Selector Application
 """
 
 # Packages
-# OMERO
-import omero
-from omero.gateway import BlitzGateway
-from omero.rtypes import rdouble, rstring
-# skimage
-from skimage.filters import threshold_yen
-from skimage.morphology import closing, square
-from skimage.segmentation import clear_border
-from skimage.measure import label, regionprops
-from skimage.io import imsave
+# omero, skimage and scipy are imported by the functions using them and
+# pandas on first use, so the window opens quickly and annotating processed
+# images needs neither omero nor skimage
 # PyQt
 import sys
 from PyQt5.QtWidgets import QApplication, QWidget, QPushButton, QCheckBox
 from PyQt5.QtWidgets import QLabel, QLineEdit, QGridLayout, QProgressBar
 from PyQt5.QtWidgets import QFileDialog
 # from PyQt5.QtWidgets import QComboBox
-from PyQt5.QtGui import QIntValidator, QIcon
+from PyQt5.QtGui import QIntValidator, QRegExpValidator, QIcon, QImage
+from PyQt5.QtGui import QPixmap
+from PyQt5.QtCore import QThread, pyqtSignal, QSize, Qt, QRegExp, QTimer
 # Data
 import numpy as np
-import pandas as pd
+import importlib
 # Files and Folders
 import os.path
+import mmap
+import argparse
+import sqlite3
+import uuid
+# Instrumentation
+import json
+import time
+import cProfile
+import traceback
+from contextlib import contextmanager
+try:
+    import resource
+except ImportError:
+    # Not available on Windows
+    resource = None
+from getpass import getpass
 import errno
-from shutil import copy
+from shutil import copy, rmtree
+# Concurrency
+import threading
+import multiprocessing
+from collections import deque, OrderedDict
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from concurrent.futures import as_completed, wait, FIRST_COMPLETED
 
 
-class miApp(QWidget):
+class lazyModule:
+    """
+    Stand-in for a module, imported when one of its attributes is first used
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.module = None
+
+    def __getattr__(self, attr):
+        if self.module is None:
+            self.module = importlib.import_module(self.name)
+        return getattr(self.module, attr)
+
+
+pd = lazyModule('pandas')
+
+# Columns of Results.csv describing each cell, the remaining ones are stages
+cellColumns = ['Cell', 'x0', 'y0', 'x1', 'y1', 't0', 't1', 'Roi']
+
+# Settings.csv written when there is none yet
+defaultSettings = {'Channel': 0, 'Duration': 20, 'Nuclei Diameter': 20,
+                   'Stages': 'Prophase,Metaphase,Anaphase,Telophase',
+                   'Two Pass': 0, 'Server Projection': 0,
+                   'Memory Budget': 0, 'Crop Layout': 'stack',
+                   'Incremental': 0, 'Tracking': 0}
+
+
+def loadSettings(path='Settings.csv'):
+    """
+    Processing settings, the defaults are written to path if it doesn't
+    exist yet, e.g. in a fresh checkout
+    """
+    try:
+        return pd.read_csv(path)
+    except FileNotFoundError:
+        print('%s not found, writing the default settings' % path)
+        settings = pd.DataFrame([defaultSettings])
+        settings.to_csv(path, index=False)
+        return settings
+
+
+class zProjection:
+    """
+    Preallocated projection buffer, filled one time point at a time. The
+    frames are stored one after the other, (T, Y, X), so a time point is one
+    contiguous block of a memory-mapped file. maxZPrj is a (Y, X, T) view.
+    Input: sizeT   number of time steps
+           method  reduction applied along Z: 'max', 'mean' or 'sum'
+           path    optional .npy file to memory-map the buffer to, so it
+                   doesn't have to fit in memory
+    """
+    methods = {'max': np.max, 'mean': np.mean, 'sum': np.sum}
+
+    def __init__(self, sizeT, method='max', path=None):
+        if method not in self.methods:
+            raise ValueError("Unknown projection method '%s'" % method)
+        self.sizeT = sizeT
+        self.path = path
+        self.reduce = self.methods[method]
+        self.frames = None
+        self.maxZPrj = None
+        self.maxPrj = None
+
+    def add(self, t, zStack):
+        """
+        Project a (Z, Y, X) stack and store it as time point t
+        """
+        plane = self.reduce(zStack, axis=0)
+        if self.maxZPrj is None:
+            # Allocate once, dtype follows the reduction of the first stack
+            self.allocate(plane.shape, plane.dtype)
+            self.maxPrj = plane.copy()
+        else:
+            # Running global max over time, so maxZPrj is not reduced again
+            np.maximum(self.maxPrj, plane, out=self.maxPrj)
+        self.frames[t] = plane
+        return plane
+
+    def allocate(self, shape, dtype):
+        shape = (self.sizeT,) + shape
+        if self.path is None:
+            self.frames = np.empty(shape, dtype=dtype)
+        else:
+            self.frames = np.lib.format.open_memmap(
+                self.path, mode='w+', dtype=dtype, shape=shape)
+        self.maxZPrj = self.frames.transpose(1, 2, 0)
+
+    def resume(self, frames, maxPrj):
+        """
+        Start from the (T, Y, X) frames of the first time points, made by an
+        earlier run, so only the following ones need to be added
+        """
+        self.allocate(frames.shape[1:], frames.dtype)
+        self.frames[:len(frames)] = frames
+        self.maxPrj = np.array(maxPrj)
+
+
+def adviseRandom(array):
+    """
+    Turn off readahead on a memory-mapped array read in small scattered
+    pieces, e.g. cell crops, where each page fault would otherwise read
+    megabytes around it
+    """
+    mapped = getattr(array, '_mmap', None)
+    if mapped is not None and hasattr(mmap, 'MADV_RANDOM'):
+        mapped.madvise(mmap.MADV_RANDOM)
+
+
+class pixelCache:
+    """
+    On-disk cache of z stacks and projections under tmp/cache, keyed by image
+    ID, channel and time point. Entries are memory-mapped when read, dropped
+    when the image has been updated on the server and evicted least recently
+    used first once the cache grows beyond maxBytes.
+    """
+
+    def __init__(self, root='tmp/cache', maxBytes=20*1024**3):
+        self.root = root
+        self.maxBytes = maxBytes
+        os.makedirs(self.root, exist_ok=True)
+
+    def folder(self, imageId):
+        return os.path.join(self.root, 'Image_%s' % imageId)
+
+    def path(self, imageId, c, t):
+        return os.path.join(self.folder(imageId), 'C%04dT%06d.npy' % (c, t))
+
+    def validate(self, image):
+        """
+        Drop cached entries of an image if it changed since they were written
+        """
+        folder = self.folder(image.getId())
+        stamp = str(image.updateEventDate())
+        stampFile = os.path.join(folder, 'updated.txt')
+        try:
+            with open(stampFile) as f:
+                if f.read() == stamp:
+                    return
+        except FileNotFoundError:
+            pass
+        rmtree(folder, ignore_errors=True)
+        os.makedirs(folder)
+        with open(stampFile, 'w') as f:
+            f.write(stamp)
+
+    def load(self, path):
+        try:
+            array = np.load(path, mmap_mode='r')
+        except (FileNotFoundError, ValueError):
+            return None
+        # Mark as recently used
+        os.utime(path)
+        return array
+
+    def save(self, path, array):
+        # Write to a temporary file first so readers never see partial data
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmpPath = path[:-len('.npy')] + '.part.npy'
+        np.save(tmpPath, array)
+        os.replace(tmpPath, path)
+
+    def get(self, imageId, c, t):
+        return self.load(self.path(imageId, c, t))
+
+    def put(self, imageId, c, t, zStack):
+        self.save(self.path(imageId, c, t), zStack)
+
+    def projectionPath(self, imageId, c, name):
+        return os.path.join(self.folder(imageId), 'C%04d_%s.npy' % (c, name))
+
+    def getProjection(self, imageId, c, name):
+        return self.load(self.projectionPath(imageId, c, name))
+
+    def putProjection(self, imageId, c, name, array):
+        path = self.projectionPath(imageId, c, name)
+        if isinstance(array, np.memmap) and array.filename is not None:
+            # Already written in the cache, see memmapProjection
+            array.flush()
+            os.replace(array.filename, path)
+        else:
+            self.save(path, array)
+
+    def memmapPath(self, imageId, c, name):
+        """
+        Temporary file to build a projection in, moved into place by
+        putProjection
+        """
+        path = self.projectionPath(imageId, c, name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        return path[:-len('.npy')] + '.part.npy'
+
+    def evict(self):
+        """
+        Remove least recently used entries until the cache fits in maxBytes
+        """
+        entries = []
+        for root, dirs, files in os.walk(self.root):
+            for file in files:
+                if file.endswith('.npy'):
+                    path = os.path.join(root, file)
+                    try:
+                        st = os.stat(path)
+                    except FileNotFoundError:
+                        # Evicted by another process
+                        continue
+                    entries.append((st.st_mtime, st.st_size, path))
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.maxBytes:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+
+
+def processingRun(folder):
+    """
+    ID of the processing run that numbered the cells in the Results.csv of
+    an image folder, '' for folders processed before runs had IDs
+    """
+    try:
+        with open(os.path.join(folder, 'Run.txt')) as f:
+            return f.read().strip()
+    except FileNotFoundError:
+        return ''
+
+
+def peakRss():
+    """
+    Peak resident memory of this process in MB, None if unknown
+    """
+    if resource is None:
+        return None
+    # ru_maxrss is in kilobytes on Linux and bytes on macOS
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss/1024**2 if sys.platform == 'darwin' else rss/1024
+
+
+class runReport:
+    """
+    Time spent in each stage and counters of one processing run, written as
+    JSON next to Results.csv. Spans with the same name add up, spans on
+    worker threads count the time of each request.
+    """
+
     def __init__(self):
+        self.spans = {}
+        self.counters = {}
+        self.lock = threading.Lock()
+
+    @contextmanager
+    def span(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(self.spans, name, time.perf_counter()-start)
+
+    def timed(self, name, func, *args, **kwargs):
+        with self.span(name):
+            return func(*args, **kwargs)
+
+    def count(self, name, amount=1):
+        self.add(self.counters, name, amount)
+
+    def add(self, table, name, amount):
+        with self.lock:
+            table[name] = table.get(name, 0) + amount
+
+    def write(self, path, **details):
+        report = dict(details, seconds=self.spans, counters=self.counters,
+                      peakRssMB=peakRss())
+        with open(path, 'w') as f:
+            json.dump(report, f, indent=1, default=str)
+
+
+def streamingThreshold(array, method='yen', chunkRows=1024):
+    """
+    Threshold of a large, possibly memory-mapped, array from a histogram
+    accumulated a few rows at a time. method names a skimage threshold
+    taking hist=, e.g. 'yen' or 'otsu'. Uses the same bins as skimage: one
+    per integer value for integer images, 256 otherwise.
+    """
+    from skimage import filters
+    low = min(np.min(array[k:k+chunkRows])
+              for k in range(0, array.shape[0], chunkRows))
+    high = max(np.max(array[k:k+chunkRows])
+               for k in range(0, array.shape[0], chunkRows))
+    if low == high:
+        # A single bin has no threshold, skimage returns the value for such
+        # an image
+        return low
+    if np.issubdtype(array.dtype, np.integer):
+        low, high = int(low), int(high)
+        hist = np.zeros(high-low+1, dtype=np.int64)
+        for k in range(0, array.shape[0], chunkRows):
+            chunk = np.asarray(array[k:k+chunkRows], dtype=np.int64)
+            hist += np.bincount((chunk-low).ravel(), minlength=len(hist))
+        centers = np.arange(low, high+1)
+    else:
+        hist = np.zeros(256, dtype=np.int64)
+        for k in range(0, array.shape[0], chunkRows):
+            hist += np.histogram(array[k:k+chunkRows], bins=256,
+                                 range=(low, high))[0]
+        edges = np.linspace(low, high, 257)
+        centers = (edges[:-1] + edges[1:]) / 2
+    return getattr(filters, 'threshold_'+method)(hist=(hist, centers))
+
+
+def segmentTile(tile, thresh, core, origin, shape):
+    """
+    Threshold, close and label one tile of the Max projection.
+    Input: tile    pixels of the tile with its halo
+           core    (y0, y1, x0, x1) of the tile without halo, within tile
+           origin  (y, x) of the core in the whole image
+           shape   (sizeY, sizeX) of the whole image
+    Returns per label (1..n) area, coordinate sums, brightest pixel, first
+    pixel in raster order and whether it touches the image border, plus the
+    labels along the four edges of the core for merging with the
+    neighbouring tiles.
+    """
+    from skimage.morphology import closing, square
+    from skimage.measure import label
+    y0, y1, x0, x1 = core
+    bw = closing(tile > thresh, square(3))[y0:y1, x0:x1]
+    labels, n = label(bw, return_num=True)
+    ys, xs = np.nonzero(labels)
+    found = labels[ys, xs]
+    peak = np.full(n+1, -np.inf)
+    np.maximum.at(peak, found, tile[y0:y1, x0:x1][ys, xs])
+    ys = ys + origin[0]
+    xs = xs + origin[1]
+    # np.nonzero is in raster order, so the first index is the first pixel
+    first = np.zeros(n+1, dtype=np.int64)
+    values, index = np.unique(found, return_index=True)
+    first[values] = ys[index].astype(np.int64)*shape[1] + xs[index]
+    onBorder = ((ys == 0) | (ys == shape[0]-1) |
+                (xs == 0) | (xs == shape[1]-1))
+    return {'n': n,
+            'area': np.bincount(found, minlength=n+1)[1:],
+            'sumY': np.bincount(found, ys, minlength=n+1)[1:],
+            'sumX': np.bincount(found, xs, minlength=n+1)[1:],
+            'peak': peak[1:],
+            'first': first[1:],
+            'border': np.bincount(found, onBorder, minlength=n+1)[1:] > 0,
+            'top': labels[0, :], 'bottom': labels[-1, :],
+            'left': labels[:, 0], 'right': labels[:, -1]}
+
+
+def seamPairs(a, b):
+    """
+    Labels touching across a seam, a and b the pixels on either side
+    """
+    pairs = [(a, b), (a[1:], b[:-1]), (a[:-1], b[1:])]
+    pairs = [np.stack(p) for p in pairs if len(p[0])]
+    pairs = np.concatenate(pairs, axis=1)
+    return pairs[:, (pairs[0] > 0) & (pairs[1] > 0)]
+
+
+def segmentTiles(maxPrj, thresh, tileSize=2048, pool=None, depth=None):
+    """
+    Equivalent of clear_border(label(closing(maxPrj > thresh, square(3))))
+    followed by regionprops_table(..., properties=('area', 'centroid',
+    'max_intensity')),
+    computed tile by tile, on pool if given, a ProcessPoolExecutor, with at
+    most depth tiles in flight (default two per core). The closing reaches
+    two pixels, so each tile is segmented with a halo of two pixels and only
+    its core is kept. Labels touching across tile seams are merged, then
+    objects touching the image border are dropped, numbered in raster order
+    as label does.
+    """
+    from scipy.sparse import coo_matrix
+    from scipy.sparse.csgraph import connected_components
+    sizeY, sizeX = maxPrj.shape
+    halo = 2
+    tiles = [(y, x) for y in range(0, sizeY, tileSize)
+             for x in range(0, sizeX, tileSize)]
+
+    def args(y, x):
+        hy0, hx0 = max(0, y-halo), max(0, x-halo)
+        hy1 = min(sizeY, y+tileSize+halo)
+        hx1 = min(sizeX, x+tileSize+halo)
+        core = (y-hy0, min(sizeY, y+tileSize)-hy0,
+                x-hx0, min(sizeX, x+tileSize)-hx0)
+        return (np.asarray(maxPrj[hy0:hy1, hx0:hx1]), thresh, core, (y, x),
+                (sizeY, sizeX))
+
+    results = {}
+    if len(tiles) == 1 or pool is None:
+        for tile in tiles:
+            results[tile] = segmentTile(*args(*tile))
+    else:
+        # Only a few tiles in flight, each one is copied to a worker
+        depth = depth or 2*(os.cpu_count() or 1)
+        pending = {}
+        for tile in tiles:
+            pending[pool.submit(segmentTile, *args(*tile))] = tile
+            if len(pending) >= depth:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    results[pending.pop(future)] = future.result()
+        for future in as_completed(pending):
+            results[pending[future]] = future.result()
+    # Number the labels of all tiles one after the other
+    offset = {}
+    total = 0
+    for tile in tiles:
+        offset[tile] = total
+        total += results[tile]['n']
+
+    def edge(tile, side):
+        labels = results[tile][side].astype(np.int64)
+        return np.where(labels > 0, labels + offset[tile], 0)
+
+    pairs = [np.zeros((2, 0), dtype=np.int64)]
+    for (y, x) in tiles:
+        right = (y, x+tileSize)
+        below = (y+tileSize, x)
+        if right in results:
+            pairs.append(seamPairs(edge((y, x), 'right'),
+                                   edge(right, 'left')))
+        if below in results:
+            pairs.append(seamPairs(edge((y, x), 'bottom'),
+                                   edge(below, 'top')))
+            # Diagonal neighbours across the tile corners
+            for corner, a, b in (((y+tileSize, x+tileSize), -1, 0),
+                                 ((y+tileSize, x-tileSize), 0, -1)):
+                if corner in results:
+                    pairs.append(seamPairs(
+                        edge((y, x), 'bottom')[[a]],
+                        edge(corner, 'top')[[b]]))
+    if not total:
+        return {'area': np.zeros(0, dtype=int), 'centroid-0': np.zeros(0),
+                'centroid-1': np.zeros(0), 'max_intensity': np.zeros(0)}
+    pairs = np.concatenate(pairs, axis=1)
+    graph = coo_matrix((np.ones(pairs.shape[1]), (pairs[0], pairs[1])),
+                       shape=(total+1, total+1))
+    count, objects = connected_components(graph, directed=False)
+    # Object of each label, label 0 is the background
+    objects = objects[1:]
+
+    def merged(key):
+        values = np.concatenate([results[tile][key] for tile in tiles])
+        return np.bincount(objects, values, minlength=count)
+
+    area = merged('area').astype(int)
+    sumY = merged('sumY')
+    sumX = merged('sumX')
+    border = merged('border') > 0
+    first = np.full(count, np.iinfo(np.int64).max)
+    np.minimum.at(first, objects,
+                  np.concatenate([results[tile]['first'] for tile in tiles]))
+    peak = np.full(count, -np.inf)
+    np.maximum.at(peak, objects,
+                  np.concatenate([results[tile]['peak'] for tile in tiles]))
+    keep = np.flatnonzero((area > 0) & ~border)
+    keep = keep[np.argsort(first[keep])]
+    return {'area': area[keep],
+            'centroid-0': sumY[keep]/area[keep],
+            'centroid-1': sumX[keep]/area[keep],
+            'max_intensity': peak[keep]}
+
+
+class nucleusTracker:
+    """
+    Links nuclei detected frame by frame into tracks. Each frame's
+    detections are put in a KD-tree and every active track is matched to
+    one of its nearest detections, closest pairs first, so there are never
+    all-pairs distances.
+    Input: maxDistance  furthest a nucleus moves between frames, in pixels
+           maxGap       frames a nucleus may be missed and keep its track
+           neighbours   candidate detections considered for each track
+    """
+
+    def __init__(self, maxDistance, maxGap=2, neighbours=3):
+        self.maxDistance = maxDistance
+        self.maxGap = maxGap
+        self.neighbours = neighbours
+        # Last position and time of every track, indexed by track
+        self.lastY = np.zeros(0)
+        self.lastX = np.zeros(0)
+        self.lastT = np.zeros(0, dtype=int)
+        # Detections of each frame as (t, track, y, x, peak) arrays
+        self.detections = []
+
+    def add(self, t, y, x, peak):
+        """
+        Link the detections of frame t, centroids y, x and brightness peak
+        """
+        from scipy.spatial import cKDTree
+        y, x = np.asarray(y, float), np.asarray(x, float)
+        track = np.full(len(y), -1)
+        active = np.flatnonzero(self.lastT >= t-1-self.maxGap)
+        if len(active) and len(y):
+            tree = cKDTree(np.column_stack([y, x]))
+            k = min(self.neighbours, len(y))
+            distance, nearest = tree.query(
+                np.column_stack([self.lastY[active], self.lastX[active]]),
+                k=k, distance_upper_bound=self.maxDistance)
+            distance = distance.reshape(len(active), k).ravel()
+            nearest = nearest.reshape(len(active), k).ravel()
+            candidates = np.repeat(active, k)
+            found = np.isfinite(distance)
+            order = np.argsort(distance[found], kind='stable')
+            taken = set()
+            for trk, det in zip(candidates[found][order],
+                                nearest[found][order]):
+                if track[det] < 0 and trk not in taken:
+                    track[det] = trk
+                    taken.add(trk)
+        new = track < 0
+        track[new] = len(self.lastT) + np.arange(new.sum())
+        self.lastY = np.concatenate([self.lastY, np.zeros(new.sum())])
+        self.lastX = np.concatenate([self.lastX, np.zeros(new.sum())])
+        self.lastT = np.concatenate([self.lastT,
+                                     np.zeros(new.sum(), dtype=int)])
+        self.lastY[track] = y
+        self.lastX[track] = x
+        self.lastT[track] = t
+        self.detections.append((np.full(len(y), t), track, y, x,
+                                np.asarray(peak, float)))
+
+    def table(self):
+        """
+        All detections, with columns t, track, y, x and peak
+        """
+        columns = ['t', 'track', 'y', 'x', 'peak']
+        if not self.detections:
+            return pd.DataFrame(columns=columns)
+        return pd.DataFrame(dict(zip(columns, (
+            np.concatenate(part) for part in zip(*self.detections)))))
+
+
+def rescaleFrames(substack):
+    """
+    Rescale the histogram of each plane of a (Y, X, T) substack to 0-255
+    """
+    minusMin = substack - substack.min(axis=(0, 1), keepdims=True)
+    peak = minusMin.max(axis=(0, 1), keepdims=True)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        frames = (minusMin/peak) * 255
+    # Flat planes become black
+    frames[:, :, peak.ravel() == 0] = 0
+    return frames.astype(np.uint8)
+
+
+def pixelsDtype(image):
+    """
+    Numpy dtype of the raw, big-endian pixel data of an image
+    """
+    pixelsType = image.getPixelsType()
+    pixelsType = {'float': 'float32', 'double': 'float64'}.get(pixelsType,
+                                                               pixelsType)
+    return np.dtype(pixelsType).newbyteorder('>')
+
+
+class levelPixels:
+    """
+    Reads planes of an image at one level of its resolution pyramid, through
+    one RawPixelsStore kept open for all requests
+    Input: conn        connected BlitzGateway
+           image       OMERO image object
+           resolution  (level, sizeX, sizeY) as returned by lowResLevel, or
+                       None for full resolution
+    """
+
+    def __init__(self, conn, image, resolution=None):
+        if resolution is None:
+            resolution = (None, image.getSizeX(), image.getSizeY())
+        self.level, self.sizeX, self.sizeY = resolution
+        self.dtype = pixelsDtype(image)
+        self.pixelsId = image.getPrimaryPixels().getId()
+        self.store = conn.createRawPixelsStore()
+        self.store.setPixelsId(self.pixelsId, True, conn.SERVICE_OPTS)
+        if self.level is not None:
+            self.store.setResolutionLevel(self.level)
+
+    def getPlane(self, z, c, t):
+        plane = np.frombuffer(self.store.getPlane(z, c, t), dtype=self.dtype)
+        plane = plane.astype(self.dtype.newbyteorder('='))
+        return plane.reshape(self.sizeY, self.sizeX)
+
+    def close(self):
+        self.store.close()
+
+
+def lowResLevel(conn, image, box_size, minBox=8):
+    """
+    Smallest pyramid level on which a cell box is still minBox pixels wide,
+    as (level, sizeX, sizeY), or None if the image has no pyramid
+    """
+    store = conn.createRawPixelsStore()
+    try:
+        store.setPixelsId(image.getPrimaryPixels().getId(), True,
+                          conn.SERVICE_OPTS)
+        levels = store.getResolutionLevels()
+        if levels < 2:
+            return None
+        # Index 0 is full resolution, level numbers count the other way
+        descriptions = store.getResolutionDescriptions()
+    finally:
+        store.close()
+    best = None
+    for index, description in enumerate(descriptions):
+        factor = image.getSizeX() / description.sizeX
+        if index > 0 and box_size/factor >= minBox:
+            best = (levels-1-index, description.sizeX, description.sizeY)
+    return best
+
+
+def mergeTiles(boxes):
+    """
+    Group boxes that overlap in space and time, so each group is fetched
+    with one tile request per plane
+    Input: boxes  array of rows (x0, y0, x1, y1, t0, t1)
+    Output: list of (tile, members), tile being the bounding
+            (x0, y0, x1, y1, t0, t1) of the boxes listed in members
+    """
+    groups = [(tuple(int(v) for v in box), [k])
+              for k, box in enumerate(boxes)]
+    merged = True
+    # Repeat until no group grew, a grown tile can overlap new ones
+    while merged:
+        merged = False
+        out = []
+        for tile, members in groups:
+            for k, (other, others) in enumerate(out):
+                if (other[0] < tile[2] and tile[0] < other[2]
+                        and other[1] < tile[3] and tile[1] < other[3]
+                        and other[4] < tile[5] and tile[4] < other[5]):
+                    tile = (min(tile[0], other[0]), min(tile[1], other[1]),
+                            max(tile[2], other[2]), max(tile[3], other[3]),
+                            min(tile[4], other[4]), max(tile[5], other[5]))
+                    out[k] = (tile, others + members)
+                    merged = True
+                    break
+            else:
+                out.append((tile, members))
+        groups = out
+    return groups
+
+
+def joinSession(conn):
+    """
+    Open a new connection that joins the session of an existing one
+    Input: conn  connected BlitzGateway
+    """
+    return joinKey(conn.host, conn.port, conn.c.getSessionId())
+
+
+def joinKey(host, port, key):
+    """
+    Open a connection to the OMERO session with this key, e.g. from another
+    process, without logging in again
+    """
+    import omero
+    from omero.gateway import BlitzGateway
+    client = omero.client(host, int(port))
+    client.joinSession(key)
+    return BlitzGateway(client_obj=client)
+
+
+class sessionPool:
+    """
+    Logs in to OMERO once and shares the session. It is kept alive on a
+    background thread, connections joined to it are handed out to threads
+    with acquire and release, and other processes can join it by its key.
+    If the session expires a new one is opened and connections to the old
+    one are dropped. close, or leaving the with block, closes everything.
+    Input: user, password, host, port  OMERO login
+           keepAlive  seconds between keep alive calls
+           key        join this session instead of logging in, e.g. in a
+                      worker process, see key(). Either a session key or a
+                      callable returning the current one, so the session
+                      can be joined again after the other process logged
+                      in anew.
+           publish    optional callable, given the key of every new session
+    """
+
+    def __init__(self, user=None, password=None, host=None, port='4064',
+                 keepAlive=60, key=None, publish=None):
+        self.user = user
+        self.password = password
+        self.host = host
+        self.port = port
+        self.keepAlive = keepAlive
+        self.joinedKey = key
+        self.publish = publish
+        self.conn = None
+        # Joined connections not in use, and every joined connection with
+        # the key of its session
+        self.idle = []
+        self.joined = {}
+        self.lock = threading.RLock()
+        self.stopped = threading.Event()
+        self.keeper = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def matches(self, user, password, host):
+        return (self.user, self.password, self.host) == (user, password, host)
+
+    def login(self):
+        if self.joinedKey is not None:
+            conn = self.join()
+        else:
+            from omero.gateway import BlitzGateway
+            conn = BlitzGateway(self.user, self.password, host=self.host,
+                                port=self.port, secure=True)
+            conn.connect()
+        if not conn.isConnected():
+            raise ConnectionError("Failed to connect to OMERO")
+        if self.publish is not None:
+            self.publish(conn.c.getSessionId())
+        return conn
+
+    def join(self):
+        """
+        Join the session of another process. If it expired, wait up to two
+        keep alive periods for that process to publish a new one.
+        """
+        if not callable(self.joinedKey):
+            return joinKey(self.host, self.port, self.joinedKey)
+        deadline = time.monotonic() + 2*self.keepAlive
+        while True:
+            key = self.joinedKey()
+            try:
+                return joinKey(self.host, self.port, key)
+            except Exception:
+                if time.monotonic() > deadline:
+                    raise
+            while self.joinedKey() == key and time.monotonic() < deadline:
+                time.sleep(1)
+
+    def gateway(self):
+        """
+        Connection owning the session, logs in on first use
+        """
+        with self.lock:
+            if self.conn is None:
+                self.conn = self.login()
+                if self.keeper is None:
+                    self.keeper = threading.Thread(target=self.keepSession,
+                                                   daemon=True)
+                    self.keeper.start()
+            return self.conn
+
+    def key(self):
+        return self.gateway().c.getSessionId()
+
+    def keepSession(self):
+        while not self.stopped.wait(self.keepAlive):
+            try:
+                self.check()
+            except Exception:
+                traceback.print_exc()
+
+    def check(self):
+        """
+        Keep the session alive, or open a new one if it expired
+        """
+        with self.lock:
+            if self.conn is None:
+                return
+            try:
+                alive = self.conn.keepAlive()
+            except Exception:
+                alive = False
+            if not alive:
+                print('OMERO session expired, connecting again')
+                self.conn.close(hard=False)
+                self.conn = None
+                for conn in self.idle:
+                    self.drop(conn)
+                self.idle = []
+                self.gateway()
+
+    def acquire(self):
+        """
+        Connection joined to the current session, for one thread at a time
+        """
+        key = self.key()
+        with self.lock:
+            while self.idle:
+                conn = self.idle.pop()
+                if self.joined[id(conn)][1] == key:
+                    return conn
+                self.drop(conn)
+        conn = joinKey(self.host, self.port, key)
+        with self.lock:
+            self.joined[id(conn)] = (conn, key)
+        return conn
+
+    def release(self, conn, failed=False):
+        """
+        Give back a connection from acquire. A connection whose request
+        failed is closed and the session checked.
+        """
+        if failed:
+            with self.lock:
+                self.drop(conn)
+            self.check()
+            return
+        with self.lock:
+            if self.stopped.is_set() or self.conn is None:
+                self.drop(conn)
+            else:
+                self.idle.append(conn)
+
+    def drop(self, conn):
+        self.joined.pop(id(conn), None)
+        try:
+            conn.close(hard=False)
+        except Exception:
+            pass
+
+    def close(self):
+        self.stopped.set()
+        with self.lock:
+            # Also the connections still in use
+            for conn, key in list(self.joined.values()):
+                self.drop(conn)
+            self.idle = []
+            if self.conn is not None:
+                # Ends the session, unless it was joined from elsewhere
+                self.conn.close(hard=self.joinedKey is None)
+                self.conn = None
+
+
+class planeFetcher:
+    """
+    Prefetches the planes of one channel on a thread pool and yields
+    (t, zStack) in time point order.
+    Input: conn     connected BlitzGateway
+           imageId  OMERO image ID
+           c        channel to fetch
+           workers  number of threads, each with its own joined connection
+           depth    maximum number of planes requested but not yet consumed
+           connect  callable returning a connection for a worker thread,
+                    defaults to joining the session of conn
+           cache    optional pixelCache, cached time points are not fetched
+                    and fetched ones are stored
+           resolution  optional (level, sizeX, sizeY) to read a lower level
+                       of the resolution pyramid, not cached
+           project  ask the server for the max Z projection of each time
+                    point, yielded as a single plane stack, not cached.
+                    Falls back to projecting locally if the server can't.
+           stats    optional runReport for request times and transfer counts
+           start    first time point, earlier ones are skipped
+           release  callable(conn, failed) to give back a connection from
+                    connect, defaults to closing it
+    """
+
+    def __init__(self, conn, imageId, c=0, workers=4, depth=16,
+                 connect=None, cache=None, resolution=None, project=False,
+                 stats=None, start=0, release=None):
+        self.conn = conn
+        self.start = start
+        self.stats = stats or runReport()
+        self.project = project and resolution is None
+        self.serverProjection = self.project
+        self.cache = cache if resolution is None and not project else None
+        self.resolution = resolution
+        self.imageId = imageId
+        self.c = c
+        self.workers = workers
+        self.depth = max(1, depth)
+        self.connect = connect or (lambda: joinSession(conn))
+        self.release = release or (lambda conn, failed: conn.close(
+            hard=False))
+        self.local = threading.local()
+        self.connections = []
+        self.stores = []
+        self.lock = threading.Lock()
+
+    def pixels(self):
+        # One connection and pixels store per worker thread, opening a store
+        # costs several round trips
+        if not hasattr(self.local, 'pixels'):
+            conn = self.connect()
+            with self.lock:
+                self.connections.append(conn)
+            image = conn.getObject('Image', self.imageId)
+            self.local.conn = conn
+            self.local.image = image
+            self.local.pixels = levelPixels(conn, image, self.resolution)
+            with self.lock:
+                self.stores.append(self.local.pixels)
+        return self.local.pixels
+
+    def dropConnection(self):
+        """
+        Give back the connection of this thread after a failed request
+        """
+        if not hasattr(self.local, 'pixels'):
+            return
+        with self.lock:
+            self.connections.remove(self.local.conn)
+            if self.local.pixels in self.stores:
+                self.stores.remove(self.local.pixels)
+                self.local.pixels.close()
+        self.release(self.local.conn, True)
+        del self.local.pixels, self.local.conn, self.local.image
+
+    def getPlane(self, z, t):
+        return self.pixels().getPlane(z, self.c, t)
+
+    def getProjection(self, t):
+        """
+        Max Z projection of time point t
+        """
+        from omero.constants.projection import ProjectionType
+        pixels = self.pixels()
+        image = self.local.image
+        if self.serverProjection:
+            try:
+                service = self.local.conn.getProjectionService()
+                plane = service.projectStack(
+                    pixels.pixelsId, None, ProjectionType.MAXIMUMINTENSITY,
+                    t, self.c, 1, 0, image.getSizeZ()-1)
+                dtype = pixelsDtype(image)
+                plane = np.frombuffer(plane, dtype=dtype)
+                plane = plane.astype(dtype.newbyteorder('='))
+                return plane.reshape(image.getSizeY(), image.getSizeX())
+            except Exception as e:
+                print('Server projection failed, projecting locally: %s' % e)
+                self.serverProjection = False
+        return np.max([self.getPlane(z, t) for z in range(image.getSizeZ())],
+                      axis=0)
+
+    def request(self, z, t):
+        if self.project:
+            return self.getProjection(t)
+        return self.getPlane(z, t)
+
+    def fetch(self, z, t):
+        with self.stats.span('fetch requests'):
+            try:
+                plane = self.request(z, t)
+            except Exception as e:
+                # The session may have expired, retry on a new connection
+                print('Fetching plane %d of time point %d failed, retrying: '
+                      '%s' % (z, t, e))
+                self.dropConnection()
+                plane = self.request(z, t)
+        self.stats.count('planes fetched')
+        self.stats.count('bytes fetched', plane.nbytes)
+        return plane
+
+    def __iter__(self):
+        image = self.conn.getObject('Image', self.imageId)
+        sizeZ = image.getSizeZ()
+        sizeT = image.getSizeT()
+        cached = {}
+        if self.cache is not None:
+            for t in range(self.start, sizeT):
+                if os.path.exists(self.cache.path(self.imageId, self.c, t)):
+                    cached[t] = True
+        # One request per time point when projecting, else one per plane
+        perT = 1 if self.project else sizeZ
+        zt = ((z, t) for t in range(self.start, sizeT) if t not in cached
+              for z in range(perT))
+        inFlight = deque()
+        pool = ThreadPoolExecutor(max_workers=self.workers)
+        try:
+            for t in range(self.start, sizeT):
+                if t in cached:
+                    zStack = self.cache.get(self.imageId, self.c, t)
+                    if zStack is not None:
+                        self.stats.count('time points from cache')
+                        yield t, zStack
+                        continue
+                    # Evicted since the start of the run, fetch directly
+                    yield t, np.array([self.getPlane(z, t)
+                                       for z in range(sizeZ)])
+                    continue
+                # Keep the queue topped up, bounded by depth
+                while len(inFlight) < max(self.depth, perT):
+                    try:
+                        z, tq = next(zt)
+                    except StopIteration:
+                        break
+                    inFlight.append(pool.submit(self.fetch, z, tq))
+                planes = [inFlight.popleft().result() for z in range(perT)]
+                zStack = np.array(planes)
+                if self.cache is not None:
+                    self.cache.put(self.imageId, self.c, t, zStack)
+                yield t, zStack
+        finally:
+            for future in inFlight:
+                future.cancel()
+            pool.shutdown(wait=True)
+            self.close()
+
+    def close(self):
+        with self.lock:
+            for store in self.stores:
+                store.close()
+            self.stores = []
+            for conn in self.connections:
+                self.release(conn, False)
+            self.connections = []
+
+
+class imagePipeline:
+    """
+    Detection, ROI saving and cropping for one image, independent of the GUI.
+    Writes tmp/Image_<id>/Settings.csv, Results.csv and the crops of each
+    cell, see writeCrops.
+    Input: conn      connected BlitzGateway
+           imageId   OMERO image ID
+           cache     pixelCache for fetched planes and projections
+           progress  optional callable(value, text) for progress updates
+           cancelled optional threading.Event, processing stops between
+                     time points and cells once it is set
+           connect   optional connection factory for the fetch threads,
+                     see planeFetcher
+           release   optional callable giving those connections back, e.g.
+                     sessionPool.release
+    """
+
+    def __init__(self, conn, imageId, cache, progress=None, cancelled=None,
+                 connect=None, release=None):
+        self.conn = conn
+        self.connect = connect
+        self.release = release
+        self.imageId = str(imageId)
+        self.cache = cache
+        self.progress = progress
+        self.cancelled = cancelled
+        self.folder = "tmp/Image_" + self.imageId
+        # Bytes allowed for large temporaries, 0 keeps everything in memory
+        self.budget = 0
+        self.stats = runReport()
+        # Tiles of the projection segmented in parallel, None uses all cores
+        self.tileSize = 2048
+        self.segmentWorkers = None
+        self.segmentPool = None
+        # Cells are numbered anew, so annotations of earlier runs no longer
+        # apply, see processingRun
+        self.newRun = True
+        # How the last run ended: finished, skipped, cancelled or failed
+        self.status = None
+
+    def report(self, value, text=None):
+        if self.progress is not None:
+            self.progress(value, text)
+
+    def isCancelled(self):
+        return self.cancelled is not None and self.cancelled.is_set()
+
+    def prepareFolder(self, settingsFile='Settings.csv'):
+        try:
+            os.mkdir('tmp')
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+        try:
+            os.mkdir(self.folder)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+        # Written with the defaults if Settings wasn't opened yet
+        loadSettings(settingsFile)
+        copy(settingsFile, self.folder+'/Settings.csv')
+        self.defaults = pd.read_csv(self.folder+'/Settings.csv')
+        colNames = cellColumns + self.defaults['Stages'][0].split(',')
+        self.df = pd.DataFrame(columns=colNames)
+
+    def run(self):
+        """
+        Process the image, returns True if Results.csv was written.
+        Writes RunReport.json with timings and counters, and Profile.prof if
+        the MITOSIS_PROFILE environment variable is set.
+        """
+        profiler = cProfile.Profile() if os.environ.get('MITOSIS_PROFILE') \
+            else None
+        status = 'failed'
+        error = None
+        try:
+            if profiler is not None:
+                profiler.enable()
+            with self.stats.span('total'):
+                done = self.process()
+            if done:
+                status = 'finished'
+            elif self.isCancelled():
+                status = 'cancelled'
+            else:
+                status = 'skipped'
+            return done
+        except Exception:
+            error = traceback.format_exc()
+            raise
+        finally:
+            if self.segmentPool is not None:
+                self.segmentPool.shutdown(cancel_futures=True)
+                self.segmentPool = None
+            if profiler is not None:
+                profiler.disable()
+            os.makedirs(self.folder, exist_ok=True)
+            if profiler is not None:
+                profiler.dump_stats(self.folder+'/Profile.prof')
+            self.status = status
+            self.stats.write(self.folder+'/RunReport.json',
+                             image=self.imageId, status=status, error=error)
+
+    def process(self):
+        self.prepareFolder()
+        image = self.conn.getObject('Image', self.imageId)
+        if image is None:
+            self.report(None, "Image %s not found, process ended"
+                        % self.imageId)
+            return False
+        sizeT = image.getSizeT()
+        sizeX = image.getSizeX()
+        sizeY = image.getSizeY()
+        if sizeT < 2:
+            self.report(None, "Image %s has a single time point, skipped"
+                        % self.imageId)
+            return False
+        p = image.getPrimaryPixels()._obj
+        scaleX = p.getPhysicalSizeX().getValue()
+        box_size = 2*np.ceil(self.defaults['Nuclei Diameter'][0]/scaleX)
+        channel = int(self.defaults['Channel'][0])
+        self.budget = int(self.setting('Memory Budget', 0))*1024**2
+        self.cache.validate(image)
+        modes = [name for name in ('Two Pass', 'Incremental', 'Tracking')
+                 if int(self.setting(name, 0))]
+        if len(modes) > 1:
+            # Settings.csv edited by hand, settingsWindow allows only one
+            print('%s can\'t be combined, only the first that applies to '
+                  'image %s is used' % (', '.join(modes), self.imageId))
+        if int(self.setting('Two Pass', 0)):
+            resolution = lowResLevel(self.conn, image, box_size)
+            if resolution is None:
+                print('Image %s has no resolution pyramid, fetching full '
+                      'planes' % self.imageId)
+            else:
+                done = self.runTwoPass(image, channel, box_size, resolution)
+                if done is not None:
+                    return done
+        if int(self.setting('Incremental', 0)):
+            return self.runIncremental(image, channel, box_size)
+        # Cached as (T, Y, X) frames, see zProjection
+        maxZPrj = self.cache.getProjection(self.imageId, channel, 'maxZFrames')
+        maxPrj = self.cache.getProjection(self.imageId, channel, 'maxPrj')
+        if maxZPrj is not None:
+            maxZPrj = maxZPrj.transpose(1, 2, 0)
+        if int(self.setting('Tracking', 0)):
+            # Nuclei are detected in each frame as it arrives
+            tracker = nucleusTracker(box_size/2)
+
+            def onFrame(t, plane):
+                self.stats.timed('detection', self.detectNuclei, tracker, t,
+                                 plane)
+        else:
+            tracker = None
+            onFrame = None
+        # Create max projection for each time
+        if maxZPrj is None or maxPrj is None:
+            path = None
+            depth = 16
+            if self.budget:
+                # Out of core, projection memory-mapped in the cache and
+                # planes in flight limited to a quarter of the budget
+                path = self.cache.memmapPath(self.imageId, channel,
+                                             'maxZFrames')
+                planeBytes = sizeX*sizeY*pixelsDtype(image).itemsize
+                depth = max(1, self.budget//(4*planeBytes))
+            projection = zProjection(sizeT, path=path)
+            if not self.fetchProjection(image, channel, projection,
+                                        depth=depth, cache=self.cache,
+                                        project=self.serverProjection(image),
+                                        onFrame=onFrame):
+                return False
+            maxZPrj = projection.maxZPrj
+            maxPrj = projection.maxPrj
+            self.cache.putProjection(self.imageId, channel, 'maxPrj', maxPrj)
+            self.cache.putProjection(self.imageId, channel, 'maxZFrames',
+                                     projection.frames)
+            if path is not None:
+                maxZPrj = self.cache.getProjection(self.imageId, channel,
+                                                   'maxZFrames')
+                maxZPrj = maxZPrj.transpose(1, 2, 0)
+            self.cache.evict()
+        elif tracker is not None:
+            for t in range(sizeT):
+                if self.isCancelled():
+                    self.report(None, "Processing cancelled")
+                    return False
+                self.report(round(t*90/sizeT-1))
+                onFrame(t, maxZPrj[:, :, t])
+        self.updateService = self.conn.getUpdateService()
+        if tracker is not None:
+            self.trackedCells(tracker, sizeX, sizeY, sizeT, box_size)
+            self.report(95, "Saving ROIs")
+            self.saveAndCrop(image, self.projectionCrops(maxZPrj))
+        else:
+            # DataFrame for storing results
+            self.stats.timed('findROIs', self.findROIs, maxPrj, sizeX, sizeY,
+                             box_size)
+            self.report(95, "Saving ROIs")
+            self.getRois(maxZPrj, image)
+        if self.isCancelled():
+            self.report(None, "Processing cancelled")
+            return False
+        self.report(100, "Processing Finished")
+        return True
+
+    def setting(self, name, default):
+        # Settings added later are missing from older Settings.csv files
+        if name in self.defaults.columns:
+            return self.defaults[name][0]
+        return default
+
+    def serverProjection(self, image):
+        return (bool(int(self.setting('Server Projection', 0)))
+                and image.getSizeZ() > 1)
+
+    def fetchProjection(self, image, channel, projection, start=0, end=90,
+                        onFrame=None, **options):
+        """
+        Fetch the time points from start on and add them to projection, with
+        progress up to end percent. Returns False if cancelled.
+        onFrame(t, plane) is called with each projected plane, options are
+        passed on to planeFetcher.
+        """
+        sizeT = image.getSizeT()
+        fetcher = iter(planeFetcher(self.conn, image.getId(), channel,
+                                    connect=self.connect,
+                                    release=self.release, stats=self.stats,
+                                    start=start, **options))
+        with self.stats.span('acquisition'):
+            for t, zStack in fetcher:
+                if self.isCancelled():
+                    # Stops the prefetching threads
+                    fetcher.close()
+                    self.report(None, "Processing cancelled")
+                    return False
+                self.report(round(t*end/sizeT-1))
+                plane = self.stats.timed('projection', projection.add, t,
+                                         zStack)
+                if onFrame is not None:
+                    onFrame(t, plane)
+        return True
+
+    def incrementalState(self, channel, box_size, sizeT):
+        """
+        Progress.json of the last incremental run of the image, None if
+        there is none, it was made with other settings or the image shrank
+        """
+        try:
+            with open(self.folder+'/Progress.json') as f:
+                state = json.load(f)
+            done = np.load(self.folder+'/maxZFrames.npy',
+                           mmap_mode='r').shape[0]
+        except (FileNotFoundError, ValueError):
+            return None
+        if (state.get('channel') != channel
+                or state.get('boxSize') != float(box_size)
+                or state.get('sizeT') != done or done > sizeT
+                or not os.path.isfile(self.folder+'/Results.csv')):
+            return None
+        return state
+
+    def runIncremental(self, image, channel, box_size):
+        """
+        Process only the time points added since the last run, for
+        acquisitions that are still growing. The projections and the number
+        of time points done are kept in the image folder (Progress.json).
+        Cells found before keep their number, ROI and annotations, crops
+        and ROIs are made for new cells and crops redone for cells whose
+        brightest time moved.
+        """
+        sizeT = image.getSizeT()
+        state = self.incrementalState(channel, box_size, sizeT)
+        done = state['sizeT'] if state is not None else 0
+        # Earlier cells keep their numbers and annotations
+        self.newRun = state is None
+        if done == sizeT:
+            self.report(100, "Image %s is up to date" % self.imageId)
+            return True
+        path = None
+        depth = 16
+        if self.budget:
+            path = self.folder+'/maxZFrames.part.npy'
+            planeBytes = image.getSizeX()*image.getSizeY()*pixelsDtype(
+                image).itemsize
+            depth = max(1, self.budget//(4*planeBytes))
+        projection = zProjection(sizeT, path=path)
+        if state is not None:
+            projection.resume(
+                np.load(self.folder+'/maxZFrames.npy', mmap_mode='r'),
+                np.load(self.folder+'/maxPrj.npy'))
+        if not self.fetchProjection(image, channel, projection, start=done,
+                                    depth=depth, cache=self.cache,
+                                    project=self.serverProjection(image)):
+            return False
+        maxZPrj = projection.maxZPrj
+        self.stats.timed('findROIs', self.findROIs, projection.maxPrj,
+                         image.getSizeX(), image.getSizeY(), box_size)
+        previous = None
+        if state is not None:
+            previous = pd.read_csv(self.folder+'/Results.csv')
+            self.addNewCells(previous)
+        self.report(95, "Saving ROIs")
+        maxTime = self.stats.timed('peak time', self.findPeaks, maxZPrj)
+        self.setTimes(maxTime, sizeT)
+        self.updateService = self.conn.getUpdateService()
+        if previous is None:
+            self.saveAndCrop(image, self.projectionCrops(maxZPrj))
+        else:
+            # Only new cells and those whose brightest time moved
+            old = previous.set_index('Cell')
+            kept = self.df.index.isin(old.index)
+            moved = kept.copy()
+            moved[kept] = (
+                (self.df.loc[kept, ['t0', 't1']].to_numpy(int) !=
+                 old.loc[self.df.index[kept], ['t0', 't1']].to_numpy(int))
+                .any(axis=1))
+            redo = self.df.index[moved | ~kept]
+            self.removeCrops(self.df.index[moved])
+            self.saveAndCrop(image, self.projectionCrops(maxZPrj, redo),
+                             previous=[])
+        if self.isCancelled():
+            self.report(None, "Processing cancelled")
+            return False
+        # Progress is recorded last, an interrupted run starts over from
+        # the previous one
+        maxPrj = projection.maxPrj
+        if path is not None:
+            projection.frames.flush()
+            del projection, maxZPrj
+            os.replace(path, self.folder+'/maxZFrames.npy')
+        else:
+            self.cache.save(self.folder+'/maxZFrames.npy', projection.frames)
+        self.cache.save(self.folder+'/maxPrj.npy', maxPrj)
+        with open(self.folder+'/Progress.json', 'w') as f:
+            json.dump({'sizeT': sizeT, 'channel': channel,
+                       'boxSize': float(box_size)}, f)
+        self.report(100, "Processing Finished")
+        return True
+
+    def addNewCells(self, previous):
+        """
+        Keep the cells of an earlier run, in previous, and append the cells
+        just found that are not within half a box of one of them, numbered
+        after the last one
+        """
+        from scipy.spatial import cKDTree
+        found = self.df
+        if len(previous) and len(found):
+            tree = cKDTree(previous[['x0', 'y0']].to_numpy(float))
+            distance, _ = tree.query(found[['x0', 'y0']].to_numpy(float),
+                                     distance_upper_bound=self.box_size/2)
+            found = found[np.isinf(distance)]
+        start = int(previous['Cell'].max())+1 if len(previous) else 0
+        cells = np.arange(start, start+len(found))
+        found = found.assign(Cell=cells).set_index(cells)
+        self.df = pd.concat([previous.set_index(previous['Cell'].to_numpy()),
+                             found.reindex(columns=previous.columns)])
+
+    def removeCrops(self, cells=None):
+        """
+        Delete the crops of these cells, or of all cells if None
+        """
+        if cells is None:
+            prefixes = ('Cell',)
+        else:
+            prefixes = tuple('Cell%04dTime' % cell for cell in cells)
+        if not prefixes:
+            return
+        for file in os.listdir(self.folder):
+            if file.startswith(prefixes) and file.endswith('.png'):
+                os.remove(os.path.join(self.folder, file))
+
+    def runTwoPass(self, image, channel, box_size, resolution):
+        """
+        Detect cells on a low resolution projection, then fetch only the
+        cell boxes at full resolution, for the time frames that are cropped.
+        Returns None without fetching them if both passes would cost more
+        than the full planes, e.g. in dense fields, which are then processed
+        as usual.
+        """
+        level, lowX, lowY = resolution
+        sizeT = image.getSizeT()
+        factor = image.getSizeX() / lowX
+        projection = zProjection(sizeT)
+        if not self.fetchProjection(image, channel, projection, end=60,
+                                    resolution=resolution):
+            return False
+        lowBox = max(1, int(round(box_size/factor)))
+        self.stats.timed('findROIs', self.findROIs, projection.maxPrj, lowX,
+                         lowY, lowBox)
+        maxTime = self.stats.timed('peak time', self.findPeaks,
+                                   projection.maxZPrj)
+        # Boxes back to full resolution, full box_size wide
+        box_size = int(box_size)
+        x0 = (self.df['x0'].to_numpy(float)*factor).astype(int)
+        y0 = (self.df['y0'].to_numpy(float)*factor).astype(int)
+        self.df['x0'] = x0
+        self.df['y0'] = y0
+        self.df['x1'] = np.minimum(image.getSizeX(), x0 + box_size)
+        self.df['y1'] = np.minimum(image.getSizeY(), y0 + box_size)
+        self.setTimes(maxTime, sizeT)
+        tiles = mergeTiles(
+            self.df[['x0', 'y0', 'x1', 'y1', 't0', 't1']].to_numpy(int))
+        # Two passes only pay off if the tiles save more than the low
+        # resolution pass cost. Tiles have every Z plane, full planes may be
+        # projected on the server.
+        sizeZ = image.getSizeZ()
+        twoPassPixels = sizeZ*(lowX*lowY*sizeT + sum(
+            (x1-x0)*(y1-y0)*(t1-t0) for (x0, y0, x1, y1, t0, t1), _ in tiles))
+        planePixels = image.getSizeX()*image.getSizeY()*sizeT
+        if not self.serverProjection(image):
+            planePixels *= sizeZ
+        if twoPassPixels >= planePixels:
+            print('Cell regions of image %s cover most of it, fetching full '
+                  'planes' % self.imageId)
+            return None
+        self.report(60, "Fetching cell regions")
+        self.updateService = self.conn.getUpdateService()
+        self.saveAndCrop(image, self.tileCrops(image, channel, tiles))
+        if self.isCancelled():
+            self.report(None, "Processing cancelled")
+            return False
+        self.report(100, "Processing Finished")
+        return True
+
+    def tileCrops(self, image, channel, tiles):
+        """
+        Fetch the cell boxes at full resolution, merged into tiles by
+        mergeTiles, and yield (cell, startTime, substack) with the Z
+        projection of each cell
+        """
+        boxes = self.df[['x0', 'y0', 'x1', 'y1', 't0', 't1']].to_numpy(int)
+        sizeZ = image.getSizeZ()
+        pixels = image.getPrimaryPixels()
+        for n, (tile, members) in enumerate(tiles):
+            if self.isCancelled():
+                return
+            self.report(60 + round(n*30/len(tiles)))
+            tx0, ty0, tx1, ty1, tt0, tt1 = tile
+            region = (tx0, ty0, tx1-tx0, ty1-ty0)
+            zctTiles = [(z, channel, t, region)
+                        for t in range(tt0, tt1) for z in range(sizeZ)]
+            with self.stats.span('fetch requests'):
+                planes = np.array(list(pixels.getTiles(zctTiles)))
+            self.stats.count('tiles fetched', len(zctTiles))
+            self.stats.count('bytes fetched', planes.nbytes)
+            # (T*Z, Y, X) to (Y, X, T), max over Z
+            planes = planes.reshape(tt1-tt0, sizeZ, ty1-ty0, tx1-tx0)
+            tileStack = np.moveaxis(planes.max(axis=1), 0, -1)
+            for cell in sorted(members):
+                x0, y0, x1, y1, t0, t1 = boxes[cell]
+                yield cell, t0, tileStack[y0-ty0:y1-ty0, x0-tx0:x1-tx0,
+                                          t0-tt0:t1-tt0]
+
+    def findROIs(self, maxPrj, sizeX, sizeY, box_size):
+        # Threshold from one histogram of the whole projection, the
+        # segmentation itself runs tile by tile
+        thresh = streamingThreshold(maxPrj)
+        regions = self.segment(maxPrj, thresh)
+        # take regions with large enough areas
+        keep = regions['area'] >= 10  # Approx diameter of bright spots
+        # draw rectangle around segmented cells
+        y0 = regions['centroid-0'][keep]
+        x0 = regions['centroid-1'][keep]
+        # Ensure numbers aren't negative
+        minr = np.maximum(0, y0-float(box_size)/2)
+        minc = np.maximum(0, x0-float(box_size)/2)
+        maxr = np.minimum(sizeY, minr + box_size)
+        maxc = np.minimum(sizeX, minc + box_size)
+        self.df = pd.DataFrame({'Cell': np.arange(len(minr)),
+                                'x0': minc.astype(int), 'y0': minr.astype(int),
+                                'x1': maxc.astype(int), 'y1': maxr.astype(int)},
+                               columns=self.df.columns)
+        self.box_size = int(box_size)
+
+    def segment(self, plane, thresh):
+        """
+        segmentTiles on a process pool started on first use and kept for
+        the rest of the run, e.g. for every frame when tracking. Its
+        workers are spawned, not forked from a process running Qt, Ice and
+        other threads. Tiles in flight are bounded by the Memory Budget.
+        """
+        pool = None
+        depth = 2*(self.segmentWorkers or os.cpu_count() or 1)
+        if self.segmentWorkers != 1 and max(plane.shape) > self.tileSize:
+            if self.segmentPool is None:
+                self.segmentPool = ProcessPoolExecutor(
+                    self.segmentWorkers,
+                    mp_context=multiprocessing.get_context('spawn'))
+            pool = self.segmentPool
+        if self.budget:
+            # A worker holds its tile, the mask and 64-bit labels
+            tileBytes = (self.tileSize+4)**2*(plane.itemsize+10)
+            depth = max(1, min(depth, self.budget//tileBytes))
+        return segmentTiles(plane, thresh, self.tileSize, pool, depth)
+
+    def detectNuclei(self, tracker, t, plane):
+        """
+        Segment one projected frame with its own threshold and add the
+        nuclei found to tracker. Otsu rather than Yen, which splits the
+        background of a single frame when nuclei cover little of it.
+        """
+        thresh = streamingThreshold(plane, 'otsu')
+        regions = self.segment(plane, thresh)
+        keep = regions['area'] >= 10  # Approx diameter of bright spots
+        tracker.add(t, regions['centroid-0'][keep],
+                    regions['centroid-1'][keep],
+                    regions['max_intensity'][keep])
+
+    def trackedCells(self, tracker, sizeX, sizeY, sizeT, box_size):
+        """
+        One cell per track, cropped around its brightest frame. The box
+        holds the nucleus over the Duration frames of the crop, so it is
+        wider than box_size if the nucleus moves.
+        """
+        detections = tracker.table()
+        # Brightest frame of each track, the first one on ties
+        brightest = detections.sort_values(['track', 'peak', 't'],
+                                           ascending=[True, False, True])
+        brightest = brightest.drop_duplicates('track').set_index('track')
+        half = round(self.defaults['Duration'][0]/2)
+        t0 = np.maximum(0, brightest['t']-half)
+        t1 = np.minimum(sizeT, brightest['t']+half)
+        # Positions within each track's crop window
+        inWindow = ((detections['t'] >= detections['track'].map(t0)) &
+                    (detections['t'] < detections['track'].map(t1)))
+        extent = detections[inWindow].groupby('track').agg(
+            minY=('y', 'min'), maxY=('y', 'max'),
+            minX=('x', 'min'), maxX=('x', 'max')).loc[brightest.index]
+        minr = np.maximum(0, extent['minY']-float(box_size)/2)
+        minc = np.maximum(0, extent['minX']-float(box_size)/2)
+        maxr = np.minimum(sizeY, minr + box_size +
+                          (extent['maxY']-extent['minY']))
+        maxc = np.minimum(sizeX, minc + box_size +
+                          (extent['maxX']-extent['minX']))
+        self.df = pd.DataFrame({'Cell': np.arange(len(extent)),
+                                'x0': minc.to_numpy(int),
+                                'y0': minr.to_numpy(int),
+                                'x1': maxc.to_numpy(int),
+                                'y1': maxr.to_numpy(int),
+                                't0': t0.to_numpy(int),
+                                't1': t1.to_numpy(int)},
+                               columns=self.df.columns)
+        self.box_size = int(box_size)
+
+    def findPeaks(self, maxZPrj, chunkT=64):
+        """
+        Brightest time of every cell box in the Max Z projection stack.
+        All boxes are box_size wide, clipped at the image edge, so a sliding
+        box maximum sampled at the box corners gives every cell at once.
+        Works on (T, Y, X) frames, so each chunk is read in one piece.
+        """
+        from scipy.ndimage import maximum_filter1d
+        y0 = self.df['y0'].to_numpy(int)
+        x0 = self.df['x0'].to_numpy(int)
+        peak = np.zeros(len(y0), dtype=int)
+        if not len(y0):
+            return peak
+        size = self.box_size
+        cval = (np.iinfo(maxZPrj.dtype).min
+                if np.issubdtype(maxZPrj.dtype, np.integer) else -np.inf)
+        frames = maxZPrj.transpose(2, 0, 1)
+        best = None
+        # Chunks of time points keep the filtered copy small
+        for start in range(0, frames.shape[0], chunkT):
+            chunk = np.asarray(frames[start:start+chunkT])
+            # Window starts at each pixel, outside the image never wins
+            boxMax = maximum_filter1d(chunk, size, axis=1, mode='constant',
+                                      cval=cval, origin=-(size//2))
+            boxMax = maximum_filter1d(boxMax, size, axis=2, mode='constant',
+                                      cval=cval, origin=-(size//2))
+            atCells = boxMax[:, y0, x0]
+            chunkBest = atCells.max(axis=0)
+            chunkPeak = atCells.argmax(axis=0) + start
+            if best is None:
+                best, peak = chunkBest, chunkPeak
+            else:
+                # Strictly greater keeps the first brightest time
+                later = chunkBest > best
+                best = np.where(later, chunkBest, best)
+                peak = np.where(later, chunkPeak, peak)
+        return peak
+
+    # helper function for creating an ROI and linking it to new shapes
+    def create_roi(self, img, shapes):
+        from omero.model import RoiI
+        # create an ROI, link it to Image
+        roi = RoiI()
+        # use the omero.model.ImageI that underlies the 'image' wrapper
+        roi.setImage(img._obj)
+        for shape in shapes:
+            roi.addShape(shape)
+        # Not saved yet, see saveRois
+        return roi
+
+    def previousRois(self, img):
+        """
+        ROIs saved for this image by an earlier run, as listed in its
+        Results.csv, in the same order. The results of a run that didn't
+        complete are kept aside in PreviousResults.csv, see saveAndCrop.
+        """
+        previous = None
+        for name in ('Results.csv', 'PreviousResults.csv'):
+            try:
+                previous = pd.read_csv(self.folder+'/'+name)
+                break
+            except FileNotFoundError:
+                pass
+        if previous is None or 'Roi' not in previous.columns:
+            return []
+        roiIds = [int(i) for i in previous['Roi'].dropna()]
+        if not roiIds:
+            return []
+        # One call for all ROIs of the image, shapes included
+        result = self.conn.getRoiService().findByImage(img.getId(), None)
+        onServer = {roi.getId().getValue(): roi for roi in result.rois}
+        return [onServer[i] for i in roiIds if i in onServer]
+
+    def reusedShape(self, roi):
+        """
+        Rectangle of an ROI of an earlier run that can be moved to a new
+        cell, None if the ROI has other shapes
+        """
+        from omero.model import RectangleI
+        if roi.sizeOfShapes() != 1:
+            return None
+        shape = roi.getShape(0)
+        return shape if isinstance(shape, RectangleI) else None
+
+    def saveRois(self, img, rects, chunkSize=500, previous=(),
+                 created=None):
+        """
+        Save one ROI per rectangle with a few saveAndReturnArray calls and
+        return the ROI IDs. The ROIs of an earlier run, in previous, are
+        reused for the first rectangles rather than duplicated, but only
+        changed by updateRois once the run completed. The IDs of new ROIs
+        are appended to the created list as they are saved. Stops between
+        calls if the run is cancelled.
+        """
+        roiIds = []
+        rois = []
+        for k, rect in enumerate(rects):
+            if k < len(previous) and self.reusedShape(previous[k]):
+                roiIds.append(previous[k].getId().getValue())
+            else:
+                roiIds.append(None)
+                rois.append(self.create_roi(img, [rect]))
+        newIds = []
+        for start in range(0, len(rois), chunkSize):
+            if self.isCancelled():
+                return roiIds
+            saved = self.updateService.saveAndReturnArray(
+                rois[start:start+chunkSize])
+            self.stats.count('ROIs saved', len(saved))
+            savedIds = [roi.getId().getValue() for roi in saved]
+            newIds.extend(savedIds)
+            if created is not None:
+                created.extend(savedIds)
+        newIds = iter(newIds)
+        return [next(newIds) if i is None else i for i in roiIds]
+
+    def updateRois(self, rects, previous, chunkSize=500):
+        """
+        Move the reused ROIs of an earlier run to the rectangles of this
+        one, see saveRois, and delete the left over ones
+        """
+        rois = []
+        for roi, rect in zip(previous, rects):
+            shape = self.reusedShape(roi)
+            if shape is None:
+                continue
+            shape.x = rect.x
+            shape.y = rect.y
+            shape.width = rect.width
+            shape.height = rect.height
+            shape.textValue = rect.textValue
+            rois.append(roi)
+        for start in range(0, len(rois), chunkSize):
+            saved = self.updateService.saveAndReturnArray(
+                rois[start:start+chunkSize])
+            self.stats.count('ROIs saved', len(saved))
+        unused = [roi.getId().getValue() for roi in previous[len(rects):]]
+        if unused:
+            self.conn.deleteObjects('Roi', unused, wait=True)
+
+    def setTimes(self, maxTime, sizeT):
+        # Get substack around the brightest time, Duration frames in total
+        half = round(self.defaults['Duration'][0]/2)
+        self.df['t0'] = np.maximum(0, maxTime-half)
+        self.df['t1'] = np.minimum(sizeT, maxTime+half)
+
+    def getRois(self, maxZPrj, img):
+        chunkT = 64
+        if self.budget:
+            # Filtering makes about three copies of each chunk
+            frameBytes = maxZPrj.shape[0]*maxZPrj.shape[1]*maxZPrj.itemsize
+            chunkT = max(1, self.budget//(3*frameBytes))
+        maxTime = self.stats.timed('peak time', self.findPeaks, maxZPrj,
+                                   chunkT)
+        self.setTimes(maxTime, maxZPrj.shape[2])
+        self.saveAndCrop(img, self.projectionCrops(maxZPrj))
+
+    def saveAndCrop(self, img, substacks, previous=None):
+        """
+        Save an ROI for each cell that has none yet and write the crops,
+        then Results.csv. previous overrides the ROIs of an earlier run to
+        reuse, see saveRois, [] only adds new ones.
+        """
+        from omero.model import RectangleI
+        from omero.rtypes import rdouble, rstring
+        missing = self.df.index[self.df['Roi'].isna()]
+        rects = []
+        for cell, corner in self.df.loc[missing].iterrows():
+            # Create roi, pushed to OMERO in batches
+            rect = RectangleI()
+            rect.x = rdouble(corner['x0'])
+            rect.y = rdouble(corner['y0'])
+            rect.width = rdouble(corner['x1']-corner['x0'])
+            rect.height = rdouble(corner['y1']-corner['y0'])
+            comment = 'Cell '+str(cell)
+            rect.textValue = rstring(comment)
+            # rect.theZ = rint(z)
+            # rect.theT = rint(t)
+            rects.append(rect)
+        if previous is None:
+            previous = self.previousRois(img)
+        if self.newRun:
+            # Until this run completed, the folder holds no results, so its
+            # annotations and isProcessed don't take the new crops for the
+            # old cells. The old ROI IDs stay in PreviousResults.csv.
+            self.setResultsAside()
+            # Crops of an earlier run have other numbers, boxes or times and
+            # would be listed with the new ones, see cellIndex
+            self.removeCrops()
+        # Save ROIs in the background while the crops are written
+        created = []
+        with ThreadPoolExecutor(max_workers=1) as pool:
+            saving = pool.submit(self.stats.timed, 'ROI save', self.saveRois,
+                                 img, rects, previous=previous,
+                                 created=created)
+            try:
+                self.stats.timed('crop export', self.writeCrops, substacks)
+                roiIds = saving.result()
+                if not self.isCancelled():
+                    self.stats.timed('ROI save', self.updateRois, rects,
+                                     previous)
+            except BaseException:
+                # Not listed in any Results.csv, the next run would save
+                # them again
+                wait([saving])
+                self.deleteRois(created)
+                raise
+        self.stats.count('cells', len(self.df))
+        if self.isCancelled():
+            # Results.csv is not written, so the image is redone
+            self.deleteRois(created)
+            return
+        self.df.loc[missing, 'Roi'] = roiIds
+        self.df['Roi'] = self.df['Roi'].astype(int)
+        if self.newRun:
+            # Before Results.csv, so old annotations never match new cells
+            with open(self.folder+'/Run.txt', 'w') as f:
+                f.write(uuid.uuid4().hex)
+        self.df.to_csv('tmp/Image_%s/Results.csv' % self.imageId, index=False)
+        if os.path.isfile(self.folder+'/PreviousResults.csv'):
+            os.remove(self.folder+'/PreviousResults.csv')
+
+    def setResultsAside(self):
+        """
+        Move Results.csv to PreviousResults.csv and remove Run.txt. If an
+        earlier run didn't complete either, its PreviousResults.csv is kept.
+        """
+        results = self.folder+'/Results.csv'
+        if os.path.isfile(results):
+            os.replace(results, self.folder+'/PreviousResults.csv')
+        if os.path.isfile(self.folder+'/Run.txt'):
+            os.remove(self.folder+'/Run.txt')
+
+    def deleteRois(self, roiIds):
+        """
+        Remove ROIs saved by a run that didn't finish
+        """
+        if not roiIds:
+            return
+        try:
+            self.conn.deleteObjects('Roi', roiIds, wait=True)
+        except Exception as e:
+            print('Deleting %d ROIs of image %s failed: %s'
+                  % (len(roiIds), self.imageId, e))
+
+    def projectionCrops(self, maxZPrj, cells=None):
+        adviseRandom(maxZPrj)
+        rows = self.df if cells is None else self.df.loc[cells]
+        for cell, corner in rows.iterrows():
+            startTime = int(corner['t0'])
+            yield cell, startTime, maxZPrj[int(corner['y0']):int(corner['y1']),
+                                           int(corner['x0']):int(corner['x1']),
+                                           startTime:int(corner['t1'])]
+
+    def writeCrops(self, substacks, workers=None):
+        """
+        Write the (cell, startTime, substack) crops, as one sprite sheet
+        .png per cell (frames side by side), or with the 'frames' Crop
+        Layout one .png per cell and time frame. Encoding runs on a thread
+        pool, with a bounded number of cells waiting to be written.
+        """
+        layout = self.setting('Crop Layout', 'stack')
+        workers = workers or os.cpu_count() or 1
+        writing = deque()
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            for cell, startTime, substack in substacks:
+                if self.isCancelled():
+                    break
+                frames = rescaleFrames(substack)
+                writing.append(pool.submit(self.saveCrop, layout, cell,
+                                           startTime, frames))
+                while len(writing) > 2*workers:
+                    writing.popleft().result()
+            for future in writing:
+                future.result()
+
+    def saveCrop(self, layout, cell, startTime, frames):
+        from skimage.io import imsave
+        if layout == 'frames':
+            # Save each plane of substack as .png
+            for k in range(frames.shape[2]):
+                imName = "tmp/Image_%s/Cell%04dTime%04d.png" % (self.imageId,
+                                                                cell,
+                                                                k+startTime)
+                imsave(imName, frames[:, :, k], check_contrast=False)
+                self.stats.count('files written')
+        else:
+            # (Y, X, T) to a (Y, T*X) sprite sheet, see cellIndex
+            sprite = frames.transpose(0, 2, 1).reshape(frames.shape[0], -1)
+            imName = "tmp/Image_%s/Cell%04dTime%04d-%04d.png" % (
+                self.imageId, cell, startTime, startTime+frames.shape[2])
+            imsave(imName, sprite, check_contrast=False)
+            self.stats.count('files written')
+
+
+class processWorker(QThread):
+    """
+    Runs imagePipeline on its own thread for each queued image, so the
+    window stays responsive. Progress is sent with the progressChanged
+    signal, each finished image with imageReady and failures with failed.
+    """
+    progressChanged = pyqtSignal(object, object)
+    imageReady = pyqtSignal(str)
+    failed = pyqtSignal(str)
+
+    def __init__(self, sessions, imageIds, cache):
+        super().__init__()
+        self.sessions = sessions
+        self.imageIds = imageIds
+        self.cache = cache
+        self.cancelled = threading.Event()
+
+    def cancel(self):
+        self.cancelled.set()
+
+    def report(self, value, text=None):
+        self.progressChanged.emit(value, text)
+
+    def run(self):
+        conn = None
+        errors = []
+        try:
+            # Logs in on the first run only, later runs reuse the session
+            conn = self.sessions.acquire()
+            for n, imageId in enumerate(self.imageIds):
+                if self.cancelled.is_set():
+                    break
+                self.report(0, "Connected to OMERO, processing image "
+                            "%s (%d of %d)..."
+                            % (imageId, n+1, len(self.imageIds)))
+                pipeline = imagePipeline(conn, imageId, self.cache,
+                                         progress=self.report,
+                                         cancelled=self.cancelled,
+                                         connect=self.sessions.acquire,
+                                         release=self.sessions.release)
+                try:
+                    if pipeline.run():
+                        self.imageReady.emit(imageId)
+                except Exception as e:
+                    # Go on with the next images, on a new connection in
+                    # case this one is the cause
+                    traceback.print_exc()
+                    errors.append(imageId)
+                    self.failed.emit("Processing image %s failed: %s"
+                                     % (imageId, e))
+                    self.sessions.release(conn, True)
+                    conn = None
+                    conn = self.sessions.acquire()
+            if errors:
+                # Still shown once the other images are done
+                self.failed.emit("Processing failed for image %s, see the "
+                                 "console" % ', '.join(errors))
+        except Exception as e:
+            traceback.print_exc()
+            self.failed.emit("Processing failed: %s" % e)
+        finally:
+            if conn is not None:
+                self.sessions.release(conn)
+
+
+class annotationStore:
+    """
+    Append-only SQLite journal of annotation decisions, one row per image,
+    processing run, cell and stage. Each cell is committed as soon as it is
+    annotated, the latest row wins if a cell is annotated again. Rows of
+    other runs of an image are ignored, their cells were numbered
+    differently, see processingRun.
+    """
+
+    def __init__(self, path='tmp/annotations.db'):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.db = sqlite3.connect(path)
+        with self.db:
+            self.db.execute("CREATE TABLE IF NOT EXISTS annotations "
+                            "(image TEXT, run TEXT NOT NULL, cell INTEGER, "
+                            "stage TEXT, frame REAL)")
+            self.db.execute("CREATE INDEX IF NOT EXISTS annotationsCell "
+                            "ON annotations (image, run, cell)")
+
+    def save(self, imageId, run, cell, frames):
+        """
+        Record the frame chosen for each stage of a cell, NaN for none
+        """
+        with self.db:
+            self.db.executemany(
+                "INSERT INTO annotations (image, cell, stage, frame, run) "
+                "VALUES (?, ?, ?, ?, ?)",
+                [(str(imageId), int(cell), stage, frame, run)
+                 for stage, frame in frames.items()])
+
+    def annotatedCells(self, imageId, run):
+        rows = self.db.execute("SELECT DISTINCT cell FROM annotations "
+                               "WHERE image = ? AND run = ?",
+                               (str(imageId), run))
+        return {cell for cell, in rows}
+
+    def export(self, imageId, run, results):
+        """
+        Results table with the stage columns filled in from the store
+        """
+        rows = self.db.execute("SELECT cell, stage, frame FROM annotations "
+                               "WHERE image = ? AND run = ? ORDER BY rowid",
+                               (str(imageId), run)).fetchall()
+        results = results.copy()
+        if not rows:
+            return results
+        frames = pd.DataFrame(rows, columns=['Cell', 'Stage', 'Frame'])
+        frames = frames.drop_duplicates(['Cell', 'Stage'], keep='last')
+        frames = frames.pivot(index='Cell', columns='Stage', values='Frame')
+        for stage in frames.columns:
+            if stage in results.columns:
+                results[stage] = results['Cell'].map(frames[stage]).astype(
+                    float)
+        return results
+
+    def close(self):
+        self.db.close()
+
+
+def imageIds(text):
+    """
+    Image IDs typed in the GUI, separated by commas or spaces
+    """
+    return [i for i in text.replace(',', ' ').split()]
+
+
+def cellIndex(folder):
+    """
+    Map of cell number to its sorted frame files, from one directory listing.
+    Frames of a sprite sheet (CellxxxxTimet0-t1.png) are listed as
+    '<sprite>#<frame index>'.
+    """
+    cells = {}
+    for file in sorted(os.listdir(folder)):
+        if file.startswith('Cell') and file.endswith('.png'):
+            cellNo = file[file.find('Cell')+4:file.find('Time')]
+            path = os.path.join(folder, file)
+            times = file[file.find('Time')+4:file.find('.png')]
+            if '-' in times:
+                t0, t1 = (int(t) for t in times.split('-'))
+                frames = ['%s#%04d' % (path, k) for k in range(t1-t0)]
+            else:
+                frames = [path]
+            cells.setdefault(cellNo, []).extend(frames)
+    return cells
+
+
+def frameName(file):
+    """
+    Time point of a frame file, as listed by cellIndex
+    """
+    if '#' in file:
+        sprite, k = file.rsplit('#', 1)
+        times = sprite[sprite.rfind('Time')+4:sprite.rfind('.png')]
+        return '%04d' % (int(times.split('-')[0]) + int(k))
+    return file[file.find('Time')+4:file.find('.png')]
+
+
+class thumbnailCache:
+    """
+    Bounded least recently used cache of decoded frames for the annotation
+    grid. Frames are decoded to QImage on background threads, and turned into
+    QPixmap on the GUI thread when first shown.
+    Input: maxItems  number of frames kept
+           size      button size frames are scaled to
+    """
+
+    def __init__(self, maxItems=2000, size=120, workers=2):
+        self.maxItems = maxItems
+        self.size = size
+        self.images = OrderedDict()
+        self.pending = set()
+        self.lock = threading.Lock()
+        self.pool = ThreadPoolExecutor(max_workers=workers)
+
+    def decode(self, path):
+        if '#' in path:
+            # Sprite sheet frame, decode the whole sheet once
+            sprite = path.rsplit('#', 1)[0]
+            sheet = QImage(sprite)
+            times = sprite[sprite.rfind('Time')+4:sprite.rfind('.png')]
+            t0, t1 = (int(t) for t in times.split('-'))
+            decoded = {}
+            if not sheet.isNull() and t1 > t0:
+                width = sheet.width()//(t1-t0)
+                for k in range(t1-t0):
+                    decoded['%s#%04d' % (sprite, k)] = self.scale(
+                        sheet.copy(k*width, 0, width, sheet.height()))
+            decoded.setdefault(path, QImage())
+        else:
+            decoded = {path: self.scale(QImage(path))}
+        with self.lock:
+            for key, image in decoded.items():
+                self.pending.discard(key)
+                self.images[key] = image
+                self.images.move_to_end(key)
+            while len(self.images) > self.maxItems:
+                self.images.popitem(last=False)
+        return decoded[path]
+
+    def scale(self, image):
+        if not image.isNull():
+            image = image.scaled(self.size, self.size, Qt.KeepAspectRatio,
+                                 Qt.FastTransformation)
+        return image
+
+    def prefetch(self, paths):
+        with self.lock:
+            todo = [p for p in paths
+                    if p not in self.images and p not in self.pending]
+            self.pending.update(todo)
+        submitted = set()
+        for path in todo:
+            # One task per sprite sheet, it decodes all of its frames
+            source = path.rsplit('#', 1)[0]
+            if source not in submitted:
+                submitted.add(source)
+                self.pool.submit(self.decode, path)
+
+    def get(self, path):
+        """
+        QPixmap of a frame, only decoded here if not prefetched
+        """
+        with self.lock:
+            entry = self.images.get(path)
+        if entry is None:
+            entry = self.decode(path)
+        if isinstance(entry, QImage):
+            entry = QPixmap.fromImage(entry)
+        with self.lock:
+            self.images[path] = entry
+            self.images.move_to_end(path)
+        return entry
+
+    def forget(self, folder):
+        """
+        Drop the frames of an image folder, whose crops may have been
+        written anew under the same names
+        """
+        with self.lock:
+            for path in [p for p in self.images if p.startswith(folder)]:
+                del self.images[path]
+            self.pending = {p for p in self.pending
+                            if not p.startswith(folder)}
+
+    def close(self):
+        self.pool.shutdown(wait=False, cancel_futures=True)
+
+
+class miApp(QWidget):
+    """
+    Main window: processing settings and OMERO login, then annotation of
+    the cells of each processed image.
+    Input: annotate  optional list of image IDs already processed in tmp/,
+                     annotated without connecting to OMERO
+    """
+
+    def __init__(self, annotate=None):
         QWidget.__init__(self)
         # Window setup
         self.resize(600, 600)
@@ -41,9 +2171,12 @@ class miApp(QWidget):
         defaultImage = 356978
         # OMERO user input
         imageLbl = QLabel()
-        imageLbl.setText("Image ID:")
-        self.imageEdt = QLineEdit('%s' % defaultImage)
-        self.imageEdt.setValidator(QIntValidator())
+        imageLbl.setText("Image IDs:")
+        self.imageEdt = QLineEdit(', '.join(annotate) if annotate is not None
+                                  else '%s' % defaultImage)
+        # One or more IDs, processed and annotated in turn
+        self.imageEdt.setValidator(
+            QRegExpValidator(QRegExp(r'[0-9]+([ ,]+[0-9]+)*[ ,]*')))
         userLbl = QLabel()
         userLbl.setText("Username:")
         self.userEdt = QLineEdit()
@@ -65,14 +2198,21 @@ class miApp(QWidget):
         setBtn = QPushButton('Settings')
         setBtn.clicked.connect(self.showSettingsWindow)
         # Run Button
-        runBtn = QPushButton('Run')
-        runBtn.clicked.connect(self.pullOmero)
+        self.runBtn = QPushButton('Run')
+        self.runBtn.clicked.connect(self.pullOmero)
+        # Cancel Button
+        self.cancelBtn = QPushButton('Cancel')
+        self.cancelBtn.clicked.connect(self.cancelProcessing)
+        self.cancelBtn.setEnabled(False)
+        self.worker = None
+        # OMERO session kept from one Run to the next
+        self.sessions = None
         # Next Button
-        nextBtn = QPushButton('Next')
-        nextBtn.clicked.connect(self.replaceButtons)
+        self.nextBtn = QPushButton('Next')
+        self.nextBtn.clicked.connect(self.replaceButtons)
         # No Mitosis Button
-        noMit = QPushButton('No Mitosis')
-        noMit.clicked.connect(self.noMitosisButton)
+        self.noMit = QPushButton('No Mitosis')
+        self.noMit.clicked.connect(self.noMitosisButton)
         # Selection Instruction
         self.selectionLbl = QLabel()
         self.selectionLbl.setText("Click image to select time frame")
@@ -89,12 +2229,29 @@ class miApp(QWidget):
         self.grid.addWidget(self.serverEdt, 3, 1, 1, 3)
         self.grid.addWidget(self.progress, 1, 4, 1, 5)
         self.grid.addWidget(self.progressLbl, 2, 4, 1, 5)
-        self.grid.addWidget(runBtn, 4, 4, 1, 5)
+        self.grid.addWidget(self.cancelBtn, 3, 4, 1, 5)
+        self.grid.addWidget(self.runBtn, 4, 4, 1, 5)
         self.progress.hide()
+        self.annotateOnly = annotate is not None
+        if self.annotateOnly:
+            self.runBtn.setEnabled(False)
+            self.progressLbl.setText("Annotating processed images")
+        self.cache = pixelCache()
+        self.thumbnails = thumbnailCache()
+        self.annotations = annotationStore()
+        # Number of cells decoded ahead of the one being annotated
+        self.prefetchCells = 5
+        # Processed images waiting to be annotated
+        self.readyImages = deque()
+        self.results = None
+        # Results are read and frames decoded once the window is shown
+        QTimer.singleShot(0, self.loadImages)
+
+    def loadImages(self):
         rows = self.createButtons()
         self.grid.addWidget(self.selectionLbl, rows+1, 4, 1, 5)
-        self.grid.addWidget(nextBtn, rows+2, 4, 1, 5)
-        self.grid.addWidget(noMit, rows+2, 3, 1, 1)
+        self.grid.addWidget(self.nextBtn, rows+2, 4, 1, 5)
+        self.grid.addWidget(self.noMit, rows+2, 3, 1, 1)
 
     def showSettingsWindow(self):
         self.w = settingsWindow()
@@ -103,279 +2260,238 @@ class miApp(QWidget):
     def createButtons(self):
         # Image Buttons
         # grid = QGridLayout(self)
-        self.imageId = self.imageEdt.text()
-        localImages = "tmp/Image_%s/" % self.imageId
-        try:
-            self.results = pd.read_csv(localImages+"Results.csv")
-        except FileNotFoundError:
-            print('No results file found, redo processing for image %s'
-                  % self.imageId)
-            raise
-        try:
-            self.settings = pd.read_csv(localImages+"Settings.csv")
-        except FileNotFoundError:
-            print('No settings file found for image %s' % self.imageId)
         self.buttonLbl = []
         self.buttons = []
         self.buttonSt = []
-        i = -1
-        j = 0
         self.totalCells = []
-        for self.root, dirs, self.files in os.walk(localImages):
-            for file in self.files:
-                if file.endswith('.png'):
-                    cellNo = file[file.find('Cell')+4:file.find('Time')]
-                    if cellNo not in self.totalCells:
-                        self.totalCells.append(cellNo)
-                        # List of all cells
+        ids = imageIds(self.imageEdt.text())
+        if ids:
+            self.openImage(ids[0])
+        if self.annotateOnly:
+            # Annotated one after the other, as if just processed
+            self.readyImages.extend(ids[1:])
         listOfFiles = self.listFilesPerCell()
         if not listOfFiles:
             listOfFiles = list()
             listOfFiles.append('square_black.jpg')
+        elif len(listOfFiles) < self.settings['Duration'][0]:
+            # One button per frame of the longest cells, see replaceButtons
+            for k in range(self.settings['Duration'][0]-len(listOfFiles)):
+                listOfFiles.append('square_black.jpg')
         listOfFiles.sort()
         # Initialise buttons and time labels
         for file in listOfFiles:
-            self.buttons.append(QPushButton())
-            self.buttons[-1].setFixedSize(120, 120)
-            self.buttons[-1].setStyleSheet("background-image: url(%s)" % file)
+            self.addButton()
+            self.showFrame(self.buttons[-1], file)
             if file == 'square_black.jpg':
                 frame = 'No images found'
             else:
-                frame = file[file.find('Time')+4:file.find('.png')]
+                frame = frameName(file)
             # button.clicked.connect(self.output)
             text = frame + " Selected"
+            j = len(self.buttons)-1
             self.buttons[-1].clicked.connect(lambda ch, text=text,
                                              j=j: self.select(text, j))
-            # Button state, false if not selected, true if selected
-            self.buttonSt.append(False)
-            self.buttonLbl.append(QLabel())
             self.buttonLbl[-1].setText(frame)
-            hpos = j % 6
-            j += 1
-            if (hpos == 0):
-                i += 2
-            self.grid.addWidget(self.buttons[-1], i+6, hpos)
-            self.grid.addWidget(self.buttonLbl[-1], i+7, hpos)
         self.selected = []
-        return j
+        return len(self.buttons)
+
+    def addButton(self):
+        j = len(self.buttons)
+        self.buttons.append(QPushButton())
+        self.buttons[-1].setFixedSize(120, 120)
+        # Button state, false if not selected, true if selected
+        self.buttonSt.append(False)
+        self.buttonLbl.append(QLabel())
+        i = 2*(j//6)+1
+        hpos = j % 6
+        self.grid.addWidget(self.buttons[-1], i+6, hpos)
+        self.grid.addWidget(self.buttonLbl[-1], i+7, hpos)
+
+    def openImage(self, imageId):
+        """
+        Load the results and frames of a processed image for annotation
+        """
+        self.imageId = imageId
+        self.results = None
+        self.totalCells = []
+        localImages = "tmp/Image_%s/" % self.imageId
+        try:
+            self.results = pd.read_csv(localImages+"Results.csv")
+        except FileNotFoundError:
+            print('No results file found, redo processing for image %s'
+                  % self.imageId)
+            return False
+        try:
+            self.settings = pd.read_csv(localImages+"Settings.csv")
+        except FileNotFoundError:
+            print('No settings file found for image %s' % self.imageId)
+        self.stages = [name for name in self.results.columns
+                       if name not in cellColumns]
+        # List of all cells and their frames, read once. Frames decoded
+        # before are stale if the image was processed again.
+        self.cellFiles = cellIndex(localImages)
+        self.thumbnails.forget(localImages)
+        # Resume at the first cell not annotated yet in this run
+        self.run = processingRun(localImages)
+        annotated = self.annotations.annotatedCells(self.imageId, self.run)
+        self.totalCells = [cell for cell in self.cellFiles
+                           if int(cell) not in annotated]
+        return True
 
     def replaceButtons(self):
+        if self.results is None:
+            # Nothing loaded, or waiting for the next image
+            return
         if self.selectionLbl.text() == "All stages selected" or "No mitosis":
-            for k, name in enumerate(self.results.columns[7:]):
-                print(int(self.cell), name)
-                self.results.loc[self.results['Cell'] == int(self.cell),
-                                 name] = float(self.selected[k].strip(' '))
+            # Committed straight away, nothing is lost if the app crashes
+            self.annotations.save(self.imageId, self.run, int(self.cell),
+                                  {name: float(self.selected[k].strip(' '))
+                                   for k, name in enumerate(self.stages)})
             self.selected = []
             # reset all buttons
             for j in range(len(self.buttonSt)):
                 self.buttonSt[j] = False
-            listOfFiles = self.listFilesPerCell()
-            if listOfFiles:
-                # If file list short, pad with dummy images
-                if len(listOfFiles) < self.settings['Duration'][0]:
-                    for j in range(self.settings['Duration'][0]-len(listOfFiles)):
-                        listOfFiles.append('square_black.jpg')
-                listOfFiles.sort()
-                for i in range(self.settings['Duration'][0]):
-                    file = listOfFiles[i]
-                    if file == 'square_black.jpg':
-                        frame = 'NaN'
-                    else:
-                        frame = file[file.find('Time')+4:file.find('.png')]
-                    self.buttons[i].setStyleSheet(
-                        "background-image: url(%s)" % file)
-                    text = frame + " Selected"
-                    self.buttons[i].clicked.disconnect()
-                    self.buttons[i].clicked.connect(
-                        lambda ch, text=text, i=i: self.select(text, i))
-                    self.buttonLbl[i].setText(frame)
-                    self.selectionLbl.setText(
-                        "Click image to select time frame")
+            self.showCell(self.listFilesPerCell())
+
+    def showCell(self, listOfFiles):
+        if listOfFiles:
+            # If file list short, pad with dummy images
+            if len(listOfFiles) < self.settings['Duration'][0]:
+                for j in range(self.settings['Duration'][0]-len(listOfFiles)):
+                    listOfFiles.append('square_black.jpg')
+            listOfFiles.sort()
+            # Next image may have a longer Duration
+            while len(self.buttons) < self.settings['Duration'][0]:
+                self.addButton()
+                self.buttons[-1].clicked.connect(lambda ch: None)
+            for i in range(self.settings['Duration'][0]):
+                file = listOfFiles[i]
+                if file == 'square_black.jpg':
+                    frame = 'NaN'
+                else:
+                    frame = frameName(file)
+                self.showFrame(self.buttons[i], file)
+                text = frame + " Selected"
+                self.buttons[i].clicked.disconnect()
+                self.buttons[i].clicked.connect(
+                    lambda ch, text=text, i=i: self.select(text, i))
+                self.buttonLbl[i].setText(frame)
+                self.selectionLbl.setText(
+                    "Click image to select time frame")
+            # Buttons added for an image with a longer Duration still show
+            # its frames
+            for i in range(len(self.buttons)):
+                shown = i < int(self.settings['Duration'][0])
+                self.buttons[i].setVisible(shown)
+                self.buttonLbl[i].setVisible(shown)
 
     def noMitosisButton(self):
         self.selectionLbl.setText("No mitosis")
-        for k, name in enumerate(self.results.columns[7:]):
+        for k, name in enumerate(self.stages):
             try:
                 self.selected[k] = 'NaN'
             except IndexError:
                 self.selected.append('NaN')
         self.replaceButtons()
 
+    def showFrame(self, button, file):
+        # Decoded frames come from memory, no disk access when redrawing
+        button.setIcon(QIcon(self.thumbnails.get(file)))
+        button.setIconSize(QSize(120, 120))
+
     def listFilesPerCell(self):
         if self.totalCells:
-            self.cell = self.totalCells[0]
-            self.totalCells.remove(self.cell)
-            listOfFiles = []
-            start = 'Cell'+self.cell+'Time'
-            for file in self.files:
-                if file.startswith(start) and file.endswith('.png'):
-                    listOfFiles.append(os.path.join(self.root, file))
-            return listOfFiles
+            self.cell = self.totalCells.pop(0)
+            # Decode the next cells while this one is annotated
+            for cell in self.totalCells[:self.prefetchCells]:
+                self.thumbnails.prefetch(self.cellFiles[cell])
+            return list(self.cellFiles[self.cell])
         else:
-            self.results.to_csv('Image_%s_Results.csv' % self.imageId,
-                                index=False)
-            self.showOutputWindow()
+            finished = self.results is not None
+            if finished:
+                results = self.annotations.export(self.imageId, self.run,
+                                                  self.results)
+                results.to_csv('Image_%s_Results.csv' % self.imageId,
+                               index=False)
+                self.results = None
+            # Move straight on to the next processed image
+            while self.readyImages:
+                if self.openImage(self.readyImages.popleft()):
+                    return self.listFilesPerCell()
+            if self.worker is not None:
+                self.selectionLbl.setText(
+                    "Waiting for the next image to be processed")
+                return
+            if finished:
+                self.showOutputWindow()
             #mbox = QMessageBox()
             #mbox.setText("All cells analysed for image %s!" % self.imageId)
             #mbox.setDetailedText(self.results.to_string())
             #mbox.setStandardButtons(QMessageBox.Ok)
             #mbox.exec_()
 
+    def imageReady(self, imageId):
+        self.readyImages.append(imageId)
+        if self.results is None:
+            # Annotation was idle, show the new image right away
+            self.showCell(self.listFilesPerCell())
+
     def showOutputWindow(self):
         self.w = outputWindow()
         self.w.show()
 
+    def showProgress(self, value, text=None):
+        if value is not None:
+            self.progress.setValue(value)
+        if text is not None:
+            self.progressLbl.setText(text)
+
     def pullOmero(self):
-        self.imageId = self.imageEdt.text()
+        # Processing runs on a worker thread, annotation stays usable
         self.progress.show()
         self.progress.setValue(0)
-        try:
-            os.mkdir('tmp')
-        except OSError as e:
-            if e.errno != errno.EEXIST:
-                raise
-        self.folder = "tmp/Image_" + self.imageId
-        try:
-            os.mkdir(self.folder)
-        except OSError as e:
-            if e.errno != errno.EEXIST:
-                raise
-        copy('Settings.csv', self.folder+'/Settings.csv')
-        self.defaults = pd.read_csv(self.folder+'/Settings.csv')
-        colNames = ['Cell', 'x0', 'y0', 'x1', 'y1', 't0', 't1']
-        colNames = colNames + self.defaults['Stages'][0].split(',')
-        self.df = pd.DataFrame(columns=colNames)
         self.progressLbl.setText("Connecting to OMERO...")
-        self.progressLbl.repaint()
-        try:
-            with BlitzGateway(self.userEdt.text(), self.pwEdt.text(),
-                              host=self.serverEdt.text(), port='4064',
-                              secure=True) as conn:
-                self.progressLbl.setText("Connected to OMERO, processing...")
-                self.progressLbl.repaint()
-                image = conn.getObject('Image', self.imageId)
-                if image is None:
-                    self.progressLbl.setText(
-                        "Image %s not found, process ended" % self.imageId)
-                else:
-                    sizeT = image.getSizeT()
-                    sizeX = image.getSizeX()
-                    sizeY = image.getSizeY()
-                    p = image.getPrimaryPixels()._obj
-                    scaleX = p.getPhysicalSizeX().getValue()
-                    box_size = 2*np.ceil(
-                        self.defaults['Nuclei Diameter'][0]/scaleX)
-                    # If multiple time steps, create max projection for each time
-                    if sizeT > 1:
-                        for t in range(sizeT):
-                            self.progress.setValue(round(t*90/sizeT-1))
-                            zStack = self.get_z_stack(image,
-                                                      self.defaults['Channel'][0],
-                                                      t)
-                            if t == 0:
-                                maxZPrj = np.max(zStack, axis=0)
-                            else:
-                                maxZPrj = np.dstack(
-                                    [maxZPrj, np.max(zStack, axis=0)])
-                        maxPrj = np.max(maxZPrj, axis=2)
-                    np.save('maxPrj.npy', maxPrj)
-                    np.save('maxZPrj.npy', maxZPrj)
-                    # DataFrame for storing results
-                    self.findROIs(maxPrj, sizeX, sizeY, box_size)
-                    self.progress.setValue(95)
-                    self.progressLbl.setText("Saving ROIs")
-                    self.progressLbl.repaint()
-                    self.updateService = conn.getUpdateService()
-                    self.getRois(maxZPrj, image)
-                    self.progress.setValue(100)
-                    self.progressLbl.setText("Processing Finished")
-        except Exception as e:
-            print(e)
-            self.progressLbl.setText("Failed to connect to OMERO")
-            self.progressLbl.repaint()
+        login = (self.userEdt.text(), self.pwEdt.text(),
+                 self.serverEdt.text())
+        if self.sessions is None or not self.sessions.matches(*login):
+            if self.sessions is not None:
+                self.sessions.close()
+            self.sessions = sessionPool(*login)
+        self.worker = processWorker(self.sessions,
+                                    imageIds(self.imageEdt.text()),
+                                    self.cache)
+        self.worker.progressChanged.connect(self.showProgress)
+        self.worker.imageReady.connect(self.imageReady)
+        self.worker.failed.connect(self.progressLbl.setText)
+        self.worker.finished.connect(self.processingFinished)
+        self.runBtn.setEnabled(False)
+        self.cancelBtn.setEnabled(True)
+        self.worker.start()
 
-    def findROIs(self, maxPrj, sizeX, sizeY, box_size):
-        thresh = threshold_yen(maxPrj)
-        bw = closing(maxPrj > thresh, square(3))
-        cleared = clear_border(bw)
-        label_image = label(cleared)
-        for region in regionprops(label_image):
-            # take regions with large enough areas
-            if region.area >= 10:  # Approx diameter of bright spots
-                # draw rectangle around segmented cells
-                y0, x0 = region.centroid
-                # Ensure numbers aren't negative
-                minr = max(0, y0-float(box_size)/2)
-                minc = max(0, x0-float(box_size)/2)
-                maxr = min(sizeY, minr + box_size)
-                maxc = min(sizeX, minc + box_size)
-                self.df = self.df.append({'x0': int(minc), 'x1': int(maxc),
-                                          'y0': int(minr), 'y1': int(maxr)},
-                                         ignore_index=True)
+    def cancelProcessing(self):
+        if self.worker is not None:
+            self.progressLbl.setText("Cancelling...")
+            self.cancelBtn.setEnabled(False)
+            self.worker.cancel()
 
-    # helper function for creating an ROI and linking it to new shapes
-    def create_roi(self, img, shapes):
-        # create an ROI, link it to Image
-        roi = omero.model.RoiI()
-        # use the omero.model.ImageI that underlies the 'image' wrapper
-        roi.setImage(img._obj)
-        for shape in shapes:
-            roi.addShape(shape)
-        # Save the ROI (saves any linked shapes too)
-        return self.updateService.saveAndReturnObject(roi)
+    def processingFinished(self):
+        self.runBtn.setEnabled(True)
+        self.cancelBtn.setEnabled(False)
+        self.worker = None
+        if self.results is None and not self.readyImages:
+            # Annotation was waiting for an image that failed
+            self.selectionLbl.setText("No more images to annotate")
 
-    def getRois(self, maxZPrj, img):
-        # for cell, corner in enumerate(corners):
-        for cell, corner in self.df.iterrows():
-            roi = maxZPrj[int(corner['y0']):int(corner['y1']),
-                          int(corner['x0']):int(corner['x1'])]
-            # Create roi and push to OMERO
-            rect = omero.model.RectangleI()
-            rect.x = rdouble(corner['x0'])
-            rect.y = rdouble(corner['y0'])
-            rect.width = rdouble(corner['x1']-corner['x0'])
-            rect.height = rdouble(corner['y1']-corner['y0'])
-            comment = 'Cell '+str(cell)
-            rect.textValue = rstring(comment)
-            # rect.theZ = rint(z)
-            # rect.theT = rint(t)
-            self.create_roi(img, [rect])
-            # Find the brighttest time in the Max Z projection stack
-            maxAtEachTime = [np.max(roi[:, :, i]) for i in range(roi.shape[2])]
-            maxTime = maxAtEachTime.index(max(maxAtEachTime))
-            # Get substack, 20 is total number of time frames
-            startTime = max(0, maxTime-round(self.settings['Duration'][0]/2))
-            endTime = min(roi.shape[2], maxTime
-                          + round(self.settings['Duration'][0]/2))
-            substack = roi[:, :, startTime:endTime]
-            self.df.iloc[cell].at['Cell'] = cell
-            self.df.iloc[cell].at['t0'] = startTime
-            self.df.iloc[cell].at['t1'] = endTime
-            # Save each plane of substack as .png
-            for k in range(substack.shape[2]):
-                plane = substack[:, :, k]
-                # Rescale histogram of each plane
-                minusMin = plane - np.min(plane)
-                plane = (minusMin/np.max(minusMin)) * 255
-                plane = plane.astype(np.uint8)
-                imName = "tmp/Image_%s/Cell%04dTime%04d.png" % (self.imageId,
-                                                                cell,
-                                                                k+startTime)
-                imsave(imName, plane)
-        self.df.to_csv('tmp/Image_%s/Results.csv' % self.imageId, index=False)
-
-    def get_z_stack(self, img, c=0, t=0):
-        """
-        Convert OMERO image object to numpy array
-        Input: img  OMERO image object
-               c    number of colour channls
-               t    number of time steps
-        """
-        zct_list = [(z, c, t)
-                    for z in range(img.getSizeZ())]  # Set dimensions of image
-        pixels = img.getPrimaryPixels()
-        # Read in data one plane at a time
-        return np.array(list(pixels.getPlanes(zct_list)))
+    def closeEvent(self, event):
+        if self.worker is not None:
+            self.worker.cancel()
+            self.worker.wait()
+        if self.sessions is not None:
+            self.sessions.close()
+        self.thumbnails.close()
+        self.annotations.close()
+        event.accept()
 
     def select(self, text, j):
         # j is button number
@@ -391,10 +2507,10 @@ class miApp(QWidget):
             self.selected.sort()
             self.buttonSt[j] = True
         if self.selected:
-            if len(self.selected) < len(self.results.columns[7:]):
+            if len(self.selected) < len(self.stages):
                 self.selectionLbl.setText("Select %s more" % (len(
-                    self.results.columns[7:])-len(self.selected)))
-            elif len(self.selected) > len(self.results.columns[7:]):
+                    self.stages)-len(self.selected)))
+            elif len(self.selected) > len(self.stages):
                 self.selectionLbl.setText("Too many selected!")
             else:
                 self.selectionLbl.setText("All stages selected")
@@ -412,15 +2528,9 @@ class settingsWindow(QWidget):
         super().__init__()
         self.setWindowTitle('Processing Settings')
         self.setFixedWidth(700)
-        try:
-            settings = pd.read_csv('Settings.csv')
-        except FileNotFoundError:
-            dict = {'Channel': 0, 'Duration': 20, 'Nuclei Diameter': 20,
-                    'Stages': 'Prophase,Metaphase,Anaphase,Telophase'}
-            # dict = {'Image': 356978, 'Duration: 20, 'Nuclei Diameter': 120,
-            #        'Spot Diameter': 10, 'Threshold Method': ['Yen']}
-            settings = pd.DataFrame([dict])
-            settings.to_csv('Settings.csv', index=False)
+        settings = loadSettings()
+        # dict = {'Image': 356978, 'Duration: 20, 'Nuclei Diameter': 120,
+        #        'Spot Diameter': 10, 'Threshold Method': ['Yen']}
         # OMERO user input
         channelLbl = QLabel()
         channelLbl.setText("Channel")
@@ -430,6 +2540,19 @@ class settingsWindow(QWidget):
         timeFramesLbl.setText("Duration (Frames)")
         self.timeFramesEdt = QLineEdit('%d' % settings['Duration'].values)
         self.timeFramesEdt.setValidator(QIntValidator())
+        self.cropFramesCb = QCheckBox(
+            "Write one .png per cell and frame (old layout)")
+        self.cropFramesCb.setChecked(
+            settings.get('Crop Layout', ['stack'])[0] == 'frames')
+        memoryBudgetLbl = QLabel()
+        memoryBudgetLbl.setText("Memory Budget (MB, 0 for no limit)")
+        self.memoryBudgetEdt = QLineEdit(
+            '%d' % int(settings.get('Memory Budget', [0])[0]))
+        self.memoryBudgetEdt.setValidator(QIntValidator())
+        self.serverProjectionCb = QCheckBox(
+            "Project Z stacks on the server (falls back to local projection)")
+        self.serverProjectionCb.setChecked(
+            bool(int(settings.get('Server Projection', [0])[0])))
         nucleiDiameterLbl = QLabel()
         nucleiDiameterLbl.setText("Nuclei Diameter (um)")
         self.nucleiDiameterEdt = QLineEdit(
@@ -439,6 +2562,24 @@ class settingsWindow(QWidget):
         stagesLbl.setText("Stages to select, separate with commas")
         self.stagesEdt = QLineEdit(
             '%s' % settings['Stages'].values[0])
+        # Older settings files don't have the later options
+        self.twoPassCb = QCheckBox(
+            "Fetch only cell regions at full resolution (needs a pyramid)")
+        self.twoPassCb.setChecked(
+            bool(int(settings.get('Two Pass', [0])[0])))
+        self.incrementalCb = QCheckBox(
+            "Process only new time points of growing images")
+        self.incrementalCb.setChecked(
+            bool(int(settings.get('Incremental', [0])[0])))
+        self.trackingCb = QCheckBox(
+            "Detect nuclei in each frame and track them (moving cells)")
+        self.trackingCb.setChecked(
+            bool(int(settings.get('Tracking', [0])[0])))
+        # The processing modes exclude each other, see imagePipeline.process
+        self.modeCbs = (self.twoPassCb, self.incrementalCb, self.trackingCb)
+        for box in self.modeCbs:
+            box.toggled.connect(
+                lambda checked, box=box: self.selectMode(box, checked))
         # spotDiameterLbl = QLabel()
         # spotDiameterLbl.setText("Spot Diameter")
         # self.spotDiameterEdt = QLineEdit(
@@ -476,14 +2617,34 @@ class settingsWindow(QWidget):
         # grid.addWidget(self.spotDiameterEdt, 2, 1, 1, 2)
         # grid.addWidget(threshMethodLbl, 3, 0, 1, 1)
         # grid.addWidget(self.threshMethodCb, 3, 1, 1, 2)
-        grid.addWidget(saveBtn, 4, 1, 1, 2)
-        grid.addWidget(cancelBtn, 4, 0, 1, 1)
+        grid.addWidget(self.twoPassCb, 4, 0, 1, 3)
+        grid.addWidget(self.serverProjectionCb, 5, 0, 1, 3)
+        grid.addWidget(memoryBudgetLbl, 6, 0, 1, 1)
+        grid.addWidget(self.memoryBudgetEdt, 6, 1, 1, 2)
+        grid.addWidget(self.cropFramesCb, 7, 0, 1, 3)
+        grid.addWidget(self.incrementalCb, 8, 0, 1, 3)
+        grid.addWidget(self.trackingCb, 9, 0, 1, 3)
+        grid.addWidget(saveBtn, 10, 1, 1, 2)
+        grid.addWidget(cancelBtn, 10, 0, 1, 1)
+
+    def selectMode(self, box, checked):
+        if checked:
+            for other in self.modeCbs:
+                if other is not box:
+                    other.setChecked(False)
 
     def saveSettings(self):
         dict = {'Channel': self.channelEdt.text(),
                 'Duration': self.timeFramesEdt.text(),
                 'Nuclei Diameter': self.nucleiDiameterEdt.text(),
-                'Stages': self.stagesEdt.text()}
+                'Stages': self.stagesEdt.text(),
+                'Two Pass': int(self.twoPassCb.isChecked()),
+                'Server Projection': int(self.serverProjectionCb.isChecked()),
+                'Memory Budget': self.memoryBudgetEdt.text(),
+                'Crop Layout': ('frames' if self.cropFramesCb.isChecked()
+                                else 'stack'),
+                'Incremental': int(self.incrementalCb.isChecked()),
+                'Tracking': int(self.trackingCb.isChecked())}
         # 'Spot Diameter': self.spotDiameterEdt.text(),
         # 'Threshold Method': [self.threshMethodCb.currentText()]}
         settings = pd.DataFrame([dict])
@@ -542,8 +2703,140 @@ class outputWindow(QWidget):
         print("save")
 
 
+def isProcessed(imageId):
+    """
+    Results.csv is written last, so its presence marks a finished image
+    """
+    return os.path.isfile("tmp/Image_%s/Results.csv" % imageId)
+
+
+def listImageIds(conn, datasets=(), projects=(), images=()):
+    """
+    Expand datasets and projects into a list of image IDs
+    """
+    imageIds = [int(i) for i in images]
+    for projectId in projects:
+        project = conn.getObject('Project', projectId)
+        if project is None:
+            print('Project %s not found' % projectId)
+            continue
+        datasets = list(datasets) + [d.getId()
+                                     for d in project.listChildren()]
+    for datasetId in datasets:
+        dataset = conn.getObject('Dataset', datasetId)
+        if dataset is None:
+            print('Dataset %s not found' % datasetId)
+            continue
+        imageIds.extend(i.getId() for i in dataset.listChildren())
+    # Remove duplicates, keep order
+    return list(dict.fromkeys(imageIds))
+
+
+# Session of a batch worker process, joined to the one of batchMain
+workerSessions = None
+
+
+def initWorker(host, port, sharedKey):
+    """
+    sharedKey holds the key of the current session of batchMain, updated
+    when it logs in again
+    """
+    global workerSessions
+    workerSessions = sessionPool(host=host, port=port,
+                                 key=lambda: sharedKey.value.decode())
+
+
+def processImage(imageId):
+    conn = None
+    failed = True
+    try:
+        conn = workerSessions.acquire()
+        pipeline = imagePipeline(conn, imageId, pixelCache(),
+                                 connect=workerSessions.acquire,
+                                 release=workerSessions.release)
+        # Images are already processed in parallel
+        pipeline.segmentWorkers = 1
+        pipeline.run()
+        failed = False
+        # Skipped images, e.g. with a single time point, are not failures
+        return imageId, pipeline.status
+    except Exception:
+        print('Image %s failed' % imageId)
+        traceback.print_exc()
+        return imageId, 'failed'
+    finally:
+        if conn is not None:
+            workerSessions.release(conn, failed)
+
+
+def batchMain(argv):
+    """
+    Headless processing of many images, e.g.
+    python MitosisApp.py process --dataset 123 --workers 8
+    """
+    parser = argparse.ArgumentParser(
+        prog='MitosisApp.py process',
+        description='Process OMERO images without the GUI')
+    parser.add_argument('--dataset', type=int, nargs='*', default=[])
+    parser.add_argument('--project', type=int, nargs='*', default=[])
+    parser.add_argument('--image', type=int, nargs='*', default=[])
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--server', default='camdu.warwick.ac.uk')
+    parser.add_argument('--user', default=os.environ.get('OMERO_USER'))
+    parser.add_argument('--force', action='store_true',
+                        help='reprocess images that already have results')
+    args = parser.parse_args(argv)
+    user = args.user or input('Username: ')
+    password = os.environ.get('OMERO_PASSWORD') or getpass()
+    # Workers are spawned, this process runs Ice and the keep alive thread
+    context = multiprocessing.get_context('spawn')
+    # Key of the current session, the workers join it again from there
+    # after a new login
+    sharedKey = context.Array('c', 256)
+
+    def publish(key):
+        sharedKey.value = key.encode()
+
+    # One login, kept alive while the workers join its session
+    with sessionPool(user, password, args.server,
+                     publish=publish) as sessions:
+        try:
+            conn = sessions.gateway()
+        except ConnectionError as e:
+            print(e)
+            return 1
+        imageIds = listImageIds(conn, args.dataset, args.project, args.image)
+        # Growing images are checked for new time points on every run
+        settings = loadSettings()
+        incremental = int(settings.get('Incremental', [0])[0])
+        todo = [i for i in imageIds
+                if args.force or incremental or not isProcessed(i)]
+        print('%d images, %d already processed, %d to do'
+              % (len(imageIds), len(imageIds)-len(todo), len(todo)))
+        failed = 0
+        with ProcessPoolExecutor(max_workers=args.workers,
+                                 mp_context=context,
+                                 initializer=initWorker,
+                                 initargs=(sessions.host, sessions.port,
+                                           sharedKey)) as pool:
+            futures = [pool.submit(processImage, i) for i in todo]
+            for done, future in enumerate(as_completed(futures), 1):
+                imageId, status = future.result()
+                failed += status == 'failed'
+                print('[%d/%d] Image %s %s'
+                      % (done, len(todo), imageId,
+                         'done' if status == 'finished' else status))
+    return 1 if failed else 0
+
+
 if __name__ == "__main__":
+    if len(sys.argv) > 1 and sys.argv[1] == 'process':
+        sys.exit(batchMain(sys.argv[2:]))
+    annotate = None
+    if len(sys.argv) > 1 and sys.argv[1] == 'annotate':
+        # python MitosisApp.py annotate 356978 356979
+        annotate = imageIds(' '.join(sys.argv[2:]))
     app = QApplication(sys.argv)
-    window = miApp()
+    window = miApp(annotate)
     window.show()
     sys.exit(app.exec())
@@ -0,0 +1,448 @@
+"""
+CAMDU Mitosis Selector benchmarks
+Times each processing stage of MitosisApp against a local stand-in for an
+OMERO server, serving synthetic time-lapses with bright dividing nuclei.
+
+python benchmark.py --size 512 1024 --sizeT 50 200 --sizeZ 1 5 \
+    --density 100 --latency 0.002 --output bench.json
+python benchmark.py --startup
+"""
+
+# Packages
+# omero is imported by the processing benchmarks only, so --startup also
+# runs where only the annotation packages are installed
+import numpy as np
+# Timing and memory
+import time
+import tracemalloc
+# Files and Folders
+import os.path
+import sys
+import json
+import argparse
+import itertools
+import importlib
+import tempfile
+import threading
+import subprocess
+from datetime import datetime
+
+import MitosisApp
+
+
+def synthetic(sizeT, sizeZ, size, density, seed=0, dtype=np.uint16):
+    """
+    Synthetic (T, Z, Y, X) time-lapse with a noisy background and bright
+    nuclei that light up for a few frames, as when cells divide
+    Input: density  number of nuclei per megapixel
+    """
+    rng = np.random.default_rng(seed)
+    data = rng.integers(50, 150, (sizeT, sizeZ, size, size)).astype(dtype)
+    cells = max(1, int(density*size*size/1e6))
+    radius = 4
+    yy, xx = np.mgrid[-radius:radius+1, -radius:radius+1]
+    blob = np.exp(-(yy**2+xx**2)/(2*(radius/2)**2))
+    for _ in range(cells):
+        y, x = rng.integers(2*radius, size-2*radius, 2)
+        t = rng.integers(0, sizeT)
+        z = rng.integers(0, sizeZ)
+        brightness = rng.integers(1000, 4000)
+        for dt in range(-2, 3):
+            if 0 <= t+dt < sizeT:
+                spot = (blob*brightness*(1-abs(dt)/3)).astype(dtype)
+                region = data[t+dt, z, y-radius:y+radius+1,
+                              x-radius:x+radius+1]
+                np.maximum(region, spot, out=region)
+    return data
+
+
+class value:
+    # Stand-in for the rtypes returned by getPhysicalSizeX etc.
+    def __init__(self, val):
+        self.val = val
+
+    def getValue(self):
+        return self.val
+
+
+class fakePixelsObj:
+    def getPhysicalSizeX(self):
+        return value(1.0)
+
+
+class fakePixels:
+    """
+    PixelsWrapper stand-in, every request waits latency seconds
+    """
+
+    def __init__(self, image):
+        self.image = image
+        self._obj = fakePixelsObj()
+
+    def getId(self):
+        return self.image.getId()
+
+    def transfer(self, array):
+        time.sleep(self.image.latency)
+        with self.image.lock:
+            self.image.bytesSent += array.nbytes
+            self.image.requests += 1
+        return array.copy()
+
+    def getPlane(self, theZ=0, theC=0, theT=0):
+        return self.transfer(self.image.data[theT, theZ])
+
+    def getPlanes(self, zctList):
+        for z, c, t in zctList:
+            yield self.getPlane(z, c, t)
+
+    def getTiles(self, zctTileList):
+        for z, c, t, (x, y, w, h) in zctTileList:
+            yield self.transfer(self.image.data[t, z, y:y+h, x:x+w])
+
+
+class fakeRawPixelsStore:
+    """
+    RawPixelsStore stand-in, planes are returned as big-endian bytes
+    """
+
+    def __init__(self, image):
+        self.image = image
+        self.pixels = fakePixels(image)
+
+    def setPixelsId(self, pixelsId, bypass, ctx=None):
+        pass
+
+    def getPlane(self, z, c, t):
+        plane = self.pixels.getPlane(z, c, t)
+        return plane.astype(plane.dtype.newbyteorder('>')).tobytes()
+
+    def close(self):
+        pass
+
+
+class fakeImage:
+    """
+    ImageWrapper stand-in serving a (T, Z, Y, X) array
+    """
+
+    def __init__(self, imageId, data, latency=0.0):
+        from omero.model import ImageI
+        self.imageId = imageId
+        self.data = data
+        self.latency = latency
+        self.lock = threading.Lock()
+        self.bytesSent = 0
+        self.requests = 0
+        self._obj = ImageI(imageId, False)
+
+    def getId(self):
+        return self.imageId
+
+    def getSizeT(self):
+        return self.data.shape[0]
+
+    def getSizeZ(self):
+        return self.data.shape[1]
+
+    def getSizeY(self):
+        return self.data.shape[2]
+
+    def getSizeX(self):
+        return self.data.shape[3]
+
+    def getPixelsType(self):
+        return str(self.data.dtype)
+
+    def updateEventDate(self):
+        return datetime(2021, 1, 1)
+
+    def getPrimaryPixels(self):
+        return fakePixels(self)
+
+
+class fakeUpdateService:
+    """
+    Assigns IDs to saved objects, each call waits latency seconds
+    """
+
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.ids = itertools.count(1)
+        self.calls = 0
+
+    def save(self, obj):
+        from omero.rtypes import rlong
+        obj.setId(rlong(next(self.ids)))
+        return obj
+
+    def saveAndReturnObject(self, obj):
+        time.sleep(self.latency)
+        self.calls += 1
+        return self.save(obj)
+
+    def saveAndReturnArray(self, objs):
+        time.sleep(self.latency)
+        self.calls += 1
+        return [self.save(obj) for obj in objs]
+
+
+class fakeRoiResult:
+    def __init__(self, rois):
+        self.rois = rois
+
+
+class fakeRoiService:
+    def findByImage(self, imageId, options):
+        return fakeRoiResult([])
+
+
+class fakeGateway:
+    """
+    BlitzGateway stand-in for one synthetic image
+    """
+    SERVICE_OPTS = None
+
+    def __init__(self, image, latency=0.0):
+        self.image = image
+        self.updateService = fakeUpdateService(latency)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def isConnected(self):
+        return True
+
+    def getObject(self, objType, objId):
+        if objType == 'Image' and str(objId) == str(self.image.getId()):
+            return self.image
+        return None
+
+    def getUpdateService(self):
+        return self.updateService
+
+    def getRoiService(self):
+        return fakeRoiService()
+
+    def createRawPixelsStore(self):
+        return fakeRawPixelsStore(self.image)
+
+    def deleteObjects(self, objType, ids, wait=False):
+        pass
+
+    def close(self, hard=True):
+        pass
+
+
+class stageTimer:
+    """
+    Times a stage and records the peak memory allocated during it
+    """
+
+    def __init__(self, results, case, stage, amount=None, unit=None):
+        self.results = results
+        self.case = case
+        self.stage = stage
+        self.amount = amount
+        self.unit = unit
+
+    def __enter__(self):
+        tracemalloc.start()
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *args):
+        seconds = time.perf_counter() - self.start
+        current, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        result = dict(self.case, stage=self.stage, seconds=seconds,
+                      peakMemoryMB=peak/1024**2,
+                      peakRssMB=MitosisApp.peakRss())
+        if self.amount is not None:
+            result['throughput'] = self.amount/seconds if seconds else None
+            result['unit'] = self.unit
+        self.results.append(result)
+
+
+def settingsFile(folder, diameter=10, duration=10):
+    settings = MitosisApp.pd.DataFrame([{
+        'Channel': 0, 'Duration': duration, 'Nuclei Diameter': diameter,
+        'Stages': 'Prophase,Metaphase,Anaphase,Telophase'}])
+    settings.to_csv(os.path.join(folder, 'Settings.csv'), index=False)
+
+
+def benchmarkCase(case, workers, results):
+    """
+    Time every stage of the pipeline for one synthetic image
+    """
+    from omero.model import RectangleI
+    from omero.rtypes import rdouble
+    data = synthetic(case['sizeT'], case['sizeZ'], case['size'],
+                     case['density'])
+    image = fakeImage(1, data, case['latency'])
+    conn = fakeGateway(image, case['latency'])
+    megabytes = data.nbytes/1024**2
+    cache = MitosisApp.pixelCache(maxBytes=0)
+    pipeline = MitosisApp.imagePipeline(conn, image.getId(), cache,
+                                        connect=lambda: conn)
+    pipeline.prepareFolder()
+    # Fetch
+    fetcher = MitosisApp.planeFetcher(conn, image.getId(), 0,
+                                      workers=workers,
+                                      connect=lambda: conn)
+    with stageTimer(results, case, 'fetch', megabytes, 'MB/s'):
+        stacks = [zStack for t, zStack in fetcher]
+    # Projection
+    projection = MitosisApp.zProjection(case['sizeT'])
+    with stageTimer(results, case, 'projection', megabytes, 'MB/s'):
+        for t, zStack in enumerate(stacks):
+            projection.add(t, zStack)
+    del stacks
+    maxZPrj = projection.maxZPrj
+    # Threshold, label and cell table
+    with stageTimer(results, case, 'threshold/label'):
+        pipeline.findROIs(projection.maxPrj, case['size'], case['size'],
+                          2*np.ceil(pipeline.defaults['Nuclei Diameter'][0]))
+    cells = len(pipeline.df)
+    with stageTimer(results, case, 'peak time', cells, 'cells/s'):
+        pipeline.setTimes(pipeline.findPeaks(maxZPrj), case['sizeT'])
+    # ROI save
+    pipeline.updateService = conn.getUpdateService()
+    rects = []
+    for cell, corner in pipeline.df.iterrows():
+        rect = RectangleI()
+        rect.x = rdouble(corner['x0'])
+        rect.y = rdouble(corner['y0'])
+        rects.append(rect)
+    with stageTimer(results, case, 'ROI save', cells, 'ROIs/s'):
+        pipeline.saveRois(image, rects)
+    # Crop export
+    with stageTimer(results, case, 'crop export', cells, 'cells/s'):
+        pipeline.writeCrops(pipeline.projectionCrops(maxZPrj))
+    # Everything together, as run from the GUI
+    image.bytesSent = 0
+    pipeline.stats = MitosisApp.runReport()
+    with stageTimer(results, case, 'total', megabytes, 'MB/s'):
+        pipeline.run()
+    results[-1]['cells'] = cells
+    results[-1]['bytesFetched'] = image.bytesSent
+    results[-1]['spans'] = pipeline.stats.spans
+
+
+def processingBenchmarks(args):
+    # MitosisApp imports these on first use, which would be timed as part
+    # of the stages of the first case
+    for module in ('skimage.filters', 'skimage.io', 'skimage.measure',
+                   'skimage.morphology', 'scipy.ndimage',
+                   'scipy.sparse.csgraph', 'scipy.spatial'):
+        importlib.import_module(module)
+    # The first imsave loads the imageio plugin
+    with tempfile.TemporaryDirectory() as folder:
+        importlib.import_module('skimage.io').imsave(
+            os.path.join(folder, 'warmup.png'), np.zeros((8, 8), np.uint8),
+            check_contrast=False)
+    results = []
+    cwd = os.getcwd()
+    for size, sizeT, sizeZ, density, latency in itertools.product(
+            args.size, args.sizeT, args.sizeZ, args.density, args.latency):
+        case = {'size': size, 'sizeT': sizeT, 'sizeZ': sizeZ,
+                'density': density, 'latency': latency}
+        print('Benchmarking %s' % case, file=sys.stderr)
+        # Pipeline writes to tmp/ in the working directory
+        with tempfile.TemporaryDirectory() as folder:
+            os.chdir(folder)
+            try:
+                settingsFile(folder)
+                benchmarkCase(case, args.workers, results)
+            finally:
+                os.chdir(cwd)
+    return results
+
+
+# Run in a new interpreter, so nothing is imported yet
+STARTUP = """
+import time
+start = time.perf_counter()
+import sys
+import json
+sys.path.insert(0, %r)
+import MitosisApp
+from PyQt5.QtWidgets import QApplication
+imported = time.perf_counter() - start
+app = QApplication([])
+window = MitosisApp.miApp(%r)
+window.show()
+shown = time.perf_counter() - start
+# Runs loadImages, which reads the results and decodes the first frames
+app.processEvents()
+loaded = time.perf_counter() - start
+window.close()
+print(json.dumps({'importSeconds': imported, 'shownSeconds': shown,
+                  'loadedSeconds': loaded,
+                  'modules': [m for m in ('omero', 'skimage', 'scipy',
+                                          'pandas') if m in sys.modules]}))
+"""
+
+
+def startup(mode, imageIds, repeat=3):
+    """
+    Cold start of the GUI, or of the annotate only window with imageIds.
+    Times the import of MitosisApp, the window being shown and the first
+    image being loaded, and lists the heavy packages that were imported.
+    """
+    folder = os.path.dirname(os.path.abspath(__file__))
+    annotate = imageIds if mode == 'annotate' else None
+    results = []
+    for run in range(repeat):
+        start = time.perf_counter()
+        output = subprocess.run([sys.executable, '-c',
+                                 STARTUP % (folder, annotate)],
+                                capture_output=True, text=True, check=True)
+        result = json.loads(output.stdout.strip().splitlines()[-1])
+        result.update(stage='startup', mode=mode, run=run,
+                      processSeconds=time.perf_counter()-start)
+        results.append(result)
+    return results
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(
+        description='Benchmark MitosisApp processing stages on synthetic '
+                    'images served by a local fake OMERO gateway')
+    parser.add_argument('--size', type=int, nargs='+', default=[256, 512])
+    parser.add_argument('--sizeT', type=int, nargs='+', default=[50])
+    parser.add_argument('--sizeZ', type=int, nargs='+', default=[1, 5])
+    parser.add_argument('--density', type=float, nargs='+', default=[200],
+                        help='nuclei per megapixel')
+    parser.add_argument('--latency', type=float, nargs='+', default=[0.0],
+                        help='seconds added to each server request')
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--output', help='JSON file, default stdout')
+    parser.add_argument('--startup', action='store_true',
+                        help='time the cold start of the GUI and of the '
+                             'annotate only mode instead')
+    parser.add_argument('--image', nargs='*', default=[],
+                        help='processed image IDs opened by the annotate '
+                             'only mode, see --startup')
+    args = parser.parse_args(argv)
+    results = []
+    if args.startup:
+        for mode in ('gui', 'annotate'):
+            results.extend(startup(mode, args.image))
+    else:
+        results.extend(processingBenchmarks(args))
+    report = json.dumps({'numpy': np.__version__, 'results': results},
+                        indent=1)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(report)
+    else:
+        print(report)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))